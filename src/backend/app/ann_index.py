@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+
+MIN_INDEX_SIZE = 50000  # Below this many images the exact scan is fast enough
+DEFAULT_NPROBE = 8  # Inverted lists scanned per query; raise for better recall
+TRAINING_POINTS_PER_LIST = 256  # k-means is trained on a sample of this many points per list
+KMEANS_ITERATIONS = 20
+
+def kmeans(data, n_clusters, n_iter=KMEANS_ITERATIONS, seed=0):
+    """Spherical k-means on L2-normalized rows; returns normalized centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign_lists(data, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        non_empty = counts > 0
+        sums[non_empty] = np.add.reduceat(data[np.argsort(assignments, kind="stable")], starts[non_empty])
+
+        # Re-seed empty clusters with random points so every list stays in use
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = sums / norms
+    return centroids
+
+def assign_lists(data, centroids, chunk_size=65536):
+    """Index of the closest centroid (highest inner product) for every row."""
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+def build_ivf_index(projected_dataset, n_lists=None, seed=0):
+    """Build an IVF index over L2-normalized projections.
+
+    Vectors are reordered so each inverted list is one contiguous block of
+    `vectors`, with `list_ids` mapping rows back to dataset indices.
+    """
+    data = np.ascontiguousarray(projected_dataset, dtype=np.float32)
+    if n_lists is None:
+        n_lists = max(1, int(np.sqrt(len(data))))
+    n_lists = min(n_lists, len(data))
+
+    rng = np.random.default_rng(seed)
+    n_training = min(len(data), n_lists * TRAINING_POINTS_PER_LIST)
+    training = data[np.sort(rng.choice(len(data), n_training, replace=False))]
+    centroids = kmeans(training, n_lists, seed=seed).astype(np.float32)
+
+    assignments = assign_lists(data, centroids)
+    list_ids = np.argsort(assignments, kind="stable")
+    list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+    return {
+        "centroids": centroids,
+        "list_offsets": list_offsets,
+        "list_ids": list_ids,
+        "vectors": np.ascontiguousarray(data[list_ids]),
+    }
+
+def search_ivf_index(index, query, nprobe=DEFAULT_NPROBE):
+    """Scan the `nprobe` lists closest to a normalized query.
+
+    Returns the dataset indices that were scanned and their cosine similarities.
+    """
+    centroids = index["centroids"]
+    centroid_scores = centroids @ query.astype(np.float32)
+    nprobe = min(max(1, nprobe), len(centroids))
+    probed = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+    starts = index["list_offsets"][probed]
+    ends = index["list_offsets"][probed + 1]
+    rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+    scores = index["vectors"][rows] @ query.astype(np.float32)
+    return index["list_ids"][rows], scores
+
+def save_ivf_index(index, directory):
+    """Write an IVF index as one .npy per array."""
+    os.makedirs(directory, exist_ok=True)
+    for name, array in index.items():
+        np.save(os.path.join(directory, f"{name}.npy"), np.asarray(array))
+
+def load_ivf_index(directory):
+    """Memory-map an IVF index written by save_ivf_index."""
+    names = ["centroids", "list_offsets", "list_ids", "vectors"]
+    return {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in names}
+
+def exact_top_k(projected_dataset, query, top_k):
+    """Brute-force top-k by cosine similarity, used as ground truth."""
+    similarities = projected_dataset @ query
+    best = np.argpartition(-similarities, top_k - 1)[:top_k]
+    return best[np.argsort(-similarities[best])]
+
+def benchmark_recall(projected_dataset, queries, top_k=10, nprobe_values=(1, 2, 4, 8, 16, 32), n_lists=None):
+    """Report recall@top_k and mean latency of the IVF index against the exact scan."""
+    start_time = time.perf_counter()
+    index = build_ivf_index(projected_dataset, n_lists)
+    report = {
+        "size": len(projected_dataset),
+        "n_lists": len(index["centroids"]),
+        "build_seconds": time.perf_counter() - start_time,
+        "runs": [],
+    }
+
+    start_time = time.perf_counter()
+    truth = [set(exact_top_k(projected_dataset, query, top_k)) for query in queries]
+    report["exact_ms"] = (time.perf_counter() - start_time) * 1000 / len(queries)
+
+    for nprobe in nprobe_values:
+        hits = 0
+        start_time = time.perf_counter()
+        for query, expected in zip(queries, truth):
+            ids, scores = search_ivf_index(index, query, nprobe)
+            best = ids[np.argpartition(-scores, min(top_k, len(scores)) - 1)[:top_k]]
+            hits += len(expected.intersection(best.tolist()))
+        elapsed = time.perf_counter() - start_time
+        report["runs"].append({
+            "nprobe": nprobe,
+            f"recall@{top_k}": hits / (top_k * len(queries)),
+            "ms_per_query": elapsed * 1000 / len(queries),
+        })
+    return report
+
+# Main Execution
+if __name__ == "__main__":
+    # Usage: python ann_index.py [n_images] [n_queries]
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    dimensions = 50
+
+    # Clustered synthetic projections standing in for PCA embeddings of album covers
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(1000, dimensions))
+    dataset = centers[rng.integers(0, len(centers), n_images)] + 0.5 * rng.normal(size=(n_images, dimensions))
+    dataset /= np.linalg.norm(dataset, axis=1, keepdims=True)
+    queries = dataset[rng.choice(n_images, n_queries, replace=False)] + 0.1 * rng.normal(size=(n_queries, dimensions))
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    print(json.dumps(benchmark_recall(dataset.astype(np.float32), queries.astype(np.float32)), indent=2))
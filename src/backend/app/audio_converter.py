@@ -2,8 +2,28 @@ import tensorflow as tf
 from basic_pitch.inference import predict
 from basic_pitch import ICASSP_2022_MODEL_PATH
 import time
+import numpy as np
+import ffmpeg
+import imageio_ffmpeg
 from mido import Message, MidiFile, MidiTrack, bpm2tempo, second2tick
 
+def decode_audio(data, sample_rate):
+    # Decode any ffmpeg-readable recording from memory to mono float32 samples over pipes
+    out, _ = ffmpeg.input('pipe:0').output(
+        'pipe:1',
+        format='f32le',
+        acodec='pcm_f32le',
+        ar=sample_rate,
+        ac=1
+    ).run(cmd=imageio_ffmpeg.get_ffmpeg_exe(), input=data, capture_stdout=True, capture_stderr=True)
+    return np.frombuffer(out, dtype=np.float32)
+
+def note_events_to_notes(note_events):
+    # Same note list get_midi_notes would read back from save_note_events_to_midi's file:
+    # note-ons in start order, skipping events whose MIDI velocity would round down to 0
+    note_events = sorted(note_events, key=lambda x: x[0])
+    return [int(pitch) for _, _, pitch, velocity, _ in note_events if int(velocity*127) > 0]
+
 def save_note_events_to_midi(note_events, output_file, bpm=120):
     midi = MidiFile()
     track = MidiTrack()
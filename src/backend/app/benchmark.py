@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+import mido
+from PIL import Image, ImageDraw
+import midi_processor
+import image_processor
+import melody_rerank
+
+CORPUS_DIRECTORY = os.path.join("benchmarks", "corpus")
+SIZES = {
+    # (songs, images, queries)
+    "small": (100, 100, 20),
+    "medium": (1000, 1000, 50),
+    "large": (5000, 5000, 100),
+}
+REGRESSION_THRESHOLD = 0.10  # Relative slowdown (or memory growth) reported as a regression
+LOWER_IS_BETTER = ("p50_ms", "p99_ms", "peak_mib")
+HIGHER_IS_BETTER = ("throughput_per_s",)
+RERANK_TOP_N = 50  # Songs re-ranked per benchmarked query (re-ranking is off by default)
+
+def generate_midi_corpus(directory, n_songs, seed=0):
+    """Write `n_songs` random-walk melodies as MIDI files, reusing a corpus generated earlier."""
+    if os.path.isdir(directory) and len(os.listdir(directory)) == n_songs:
+        return directory
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for song_id in range(n_songs):
+        midi_file = mido.MidiFile(type=1)
+        # Most songs carry the melody on channel 0; the rest exercise the busiest-channel fallback
+        channel = 0 if song_id % 4 else int(rng.integers(1, 16))
+        for track_id in range(int(rng.integers(1, 4))):
+            track = mido.MidiTrack()
+            midi_file.tracks.append(track)
+            track.append(mido.MetaMessage("track_name", name=f"track {track_id}"))
+            pitch = int(rng.integers(48, 72))
+            for _ in range(int(rng.integers(100, 1500))):
+                pitch = int(np.clip(pitch + rng.integers(-4, 5), 0, 127))
+                track.append(mido.Message("note_on", note=pitch, velocity=int(rng.integers(40, 120)), channel=channel,
+                                          time=int(rng.integers(0, 240))))
+                track.append(mido.Message("note_off", note=pitch, channel=channel, time=int(rng.integers(60, 480))))
+        midi_file.save(os.path.join(directory, f"song_{song_id:05d}.mid"))
+    return directory
+
+def generate_image_corpus(directory, n_images, seed=0):
+    """Write `n_images` random cover-like pictures (JPEG and PNG, mixed sizes), reusing an earlier corpus."""
+    if os.path.isdir(directory) and len(os.listdir(directory)) == n_images:
+        return directory
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for image_id in range(n_images):
+        size = int(rng.choice([300, 500, 1000]))
+        image = Image.new("RGB", (size, size), tuple(int(c) for c in rng.integers(0, 256, 3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(int(rng.integers(3, 12))):
+            x0, y0 = (int(v) for v in rng.integers(0, size, 2))
+            x1, y1 = x0 + int(rng.integers(10, size // 2)), y0 + int(rng.integers(10, size // 2))
+            draw.ellipse((x0, y0, x1, y1), fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+        extension = "jpg" if image_id % 3 else "png"
+        image.save(os.path.join(directory, f"cover_{image_id:05d}.{extension}"))
+    return directory
+
+def measure(function, inputs, items_per_call=1):
+    """Time `function` over every input after one warm-up call, then rerun it under tracemalloc for peak memory.
+
+    Peak memory covers allocations in this process only, not in worker processes.
+    """
+    function(*inputs[0])
+    latencies = []
+    start_time = time.perf_counter()
+    for args in inputs:
+        call_start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - call_start)
+    total = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    function(*inputs[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "calls": len(latencies),
+        "total_s": total,
+        "throughput_per_s": len(latencies) * items_per_call / total if total > 0 else None,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "peak_mib": peak / 1024 ** 2,
+    }
+
+def run_benchmarks(size="small", seed=0, repeats=3, corpus_directory=CORPUS_DIRECTORY):
+    """Run every hot-path benchmark on the synthetic corpora of one size and return the report."""
+    n_songs, n_images, n_queries = SIZES[size]
+    midi_directory = generate_midi_corpus(os.path.join(corpus_directory, f"midi-{n_songs}-{seed}"), n_songs, seed)
+    image_directory = generate_image_corpus(os.path.join(corpus_directory, f"image-{n_images}-{seed}"), n_images, seed)
+    midi_files = sorted(os.path.join(midi_directory, name) for name in os.listdir(midi_directory))
+    image_files = sorted(os.path.join(image_directory, name) for name in os.listdir(image_directory))
+    rng = np.random.default_rng(seed)
+    results = {}
+
+    results["get_midi_notes"] = measure(midi_processor.get_midi_notes, [(path,) for path in midi_files] * repeats)
+    notes = [midi_processor.get_midi_notes(path) for path in midi_files]
+    results["get_feature"] = measure(midi_processor.get_feature, [(song_notes,) for song_notes in notes] * repeats)
+    results["process_all_midi_files_concurrently"] = measure(
+        midi_processor.process_all_midi_files_concurrently, [(midi_directory,)] * repeats, items_per_call=n_songs)
+
+    feature_index = midi_processor.build_feature_index(midi_processor.process_all_midi_files_concurrently(midi_directory))
+    queries = []
+    query_notes = []
+    for song_id in rng.choice(n_songs, n_queries):
+        start = int(rng.integers(0, max(1, len(notes[song_id]) - 200)))
+        query_notes.append(notes[song_id][start:start + 200])
+        queries.append((feature_index, midi_processor.get_feature(query_notes[-1])))
+    results["compare"] = measure(midi_processor.compare, queries * repeats)
+    # Without a time budget, so the timings show the full cost of re-ranking
+    rankings = [(feature_index, midi_processor.compare(*query), melody, RERANK_TOP_N, float("inf"))
+                for query, melody in zip(queries, query_notes)]
+    results["rerank_songs"] = measure(melody_rerank.rerank_songs, rankings * repeats)
+
+    results["initialize_dataset_concurrently"] = measure(
+        image_processor.initialize_dataset_concurrently, [(image_directory,)] * repeats, items_per_call=n_images)
+    eigenvectors, projected_dataset, mean_dataset = image_processor.initialize_dataset_concurrently(image_directory)
+    results["query_image"] = measure(
+        image_processor.query_image,
+        [(image_files[i], eigenvectors, projected_dataset, mean_dataset) for i in rng.choice(n_images, n_queries)] * repeats)
+
+    return {
+        "meta": {
+            "size": size,
+            "seed": seed,
+            "songs": n_songs,
+            "images": n_images,
+            "queries": n_queries,
+            "created_at": time.time(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+def compare_reports(baseline, candidate, threshold=REGRESSION_THRESHOLD):
+    """Relative change of every metric between two reports; entries beyond `threshold` in the bad direction are regressions."""
+    changes = []
+    for case, before in baseline["results"].items():
+        after = candidate["results"].get(case)
+        if after is None:
+            continue
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if not before.get(metric) or after.get(metric) is None:
+                continue
+            change = (after[metric] - before[metric]) / before[metric]
+            worse = change if metric in LOWER_IS_BETTER else -change
+            changes.append({
+                "case": case,
+                "metric": metric,
+                "baseline": before[metric],
+                "candidate": after[metric],
+                "change": change,
+                "regression": worse > threshold,
+            })
+    return changes
+
+# Main Execution
+if __name__ == "__main__":
+    # Usage: python benchmark.py run [--size small|medium|large] [--output results.json]
+    #        python benchmark.py compare baseline.json candidate.json [--threshold 0.1]
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion and query hot paths.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--size", choices=sorted(SIZES), default="small")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--repeats", type=int, default=3)
+    run_parser.add_argument("--output")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        report = run_benchmarks(args.size, args.seed, args.repeats)
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output)
+        print(output)
+    else:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        with open(args.candidate, "r") as f:
+            candidate = json.load(f)
+        changes = compare_reports(baseline, candidate, args.threshold)
+        for change in changes:
+            flag = "REGRESSION" if change["regression"] else ""
+            print(f"{change['case']:<38} {change['metric']:<17} {change['baseline']:>12.3f} -> {change['candidate']:>12.3f} "
+                  f"{change['change'] * 100:+7.1f}% {flag}")
+        regressions = [change for change in changes if change["regression"]]
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold * 100:.0f}%.")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,109 @@
+import base64
+import bisect
+import hashlib
+import threading
+import numpy as np
+
+NGRAM_SIZE = 3
+MAX_PAGE_SIZE = 1000
+SONG, IMAGE = 0, 1  # Songs are listed before unmapped covers, as the gallery always has
+
+def stable_id(relative_path):
+    """Numeric item id derived from its dataset path, so it survives rebuilds and paging (fits a JS number)."""
+    return int(hashlib.sha1(relative_path.encode()).hexdigest()[:12], 16)
+
+def encode_cursor(key):
+    kind, name = key
+    return base64.urlsafe_b64encode(f"{kind}/{name}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """Sort key of the last item a cursor points past; raises ValueError on malformed cursors."""
+    try:
+        kind, name = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split("/", 1)
+        return int(kind), name
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+class Catalogue:
+    """Sorted gallery listing of one dataset version, with a trigram index for substring search.
+
+    Items hold URL paths relative to the server root; `version` changes whenever
+    any listed item does, and feeds the gallery's ETag.
+    """
+
+    def __init__(self, dataset_id, files, mapping):
+        songs = sorted(path.split("/", 1)[1] for path in files if path.startswith("song/"))
+        images = sorted(name for name in (path.split("/", 1)[1] for path in files if path.startswith("album/"))
+                        if name not in mapping.mapped_images)
+
+        self.keys = [(SONG, name) for name in songs] + [(IMAGE, name) for name in images]
+        self.items = []
+        for name in songs:
+            cover, src = mapping.song_link(dataset_id, name)
+            self.items.append({"id": stable_id(f"song/{name}"), "cover": cover, "title": name, "src": src})
+        for name in images:
+            cover = f"datasets/{dataset_id}/album/{name}"
+            self.items.append({"id": stable_id(f"album/{name}"), "cover": cover, "title": name, "src": None})
+
+        self.lowercase_titles = [item["title"].lower() for item in self.items]
+        postings = {}
+        for position, title in enumerate(self.lowercase_titles):
+            for gram in {title[i:i + NGRAM_SIZE] for i in range(len(title) - NGRAM_SIZE + 1)}:
+                postings.setdefault(gram, []).append(position)
+        self.trigrams = {gram: np.array(positions, dtype=np.int64) for gram, positions in postings.items()}
+
+        digest = hashlib.sha1()
+        for item in self.items:
+            digest.update(f"{item['id']}\0{item['cover']}\0{item['src']}\n".encode())
+        self.version = digest.hexdigest()
+
+    def etag(self, base_url, search="", limit=None, offset=0, cursor=None):
+        """ETag of one gallery response: this catalogue version plus everything else that shapes the body."""
+        key = f"{self.version}\0{base_url}\0{search}\0{limit}\0{offset}\0{cursor}"
+        return '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+
+    def search(self, query):
+        """Positions (ascending) of the items whose title contains `query`, case-insensitively."""
+        query = query.strip().lower()
+        if not query:
+            return np.arange(len(self.items))
+        if len(query) < NGRAM_SIZE:
+            return np.array([i for i, title in enumerate(self.lowercase_titles) if query in title], dtype=np.int64)
+
+        grams = {query[i:i + NGRAM_SIZE] for i in range(len(query) - NGRAM_SIZE + 1)}
+        if any(gram not in self.trigrams for gram in grams):
+            return np.empty(0, dtype=np.int64)
+        lists = sorted((self.trigrams[gram] for gram in grams), key=len)
+        positions = lists[0]
+        for other in lists[1:]:
+            positions = np.intersect1d(positions, other, assume_unique=True)
+        # Trigrams can match out of order, so confirm the substring
+        return np.array([p for p in positions if query in self.lowercase_titles[p]], dtype=np.int64)
+
+    def page(self, positions, limit=None, offset=0, cursor=None):
+        """Slice search results after `cursor` (or from `offset`); returns (positions, next cursor or None)."""
+        start = offset
+        if cursor:
+            after = decode_cursor(cursor)
+            # Keys are sorted in position order, so the cursor maps to a position and then into the results
+            start = int(np.searchsorted(positions, bisect.bisect_right(self.keys, after)))
+        if limit is None:
+            return positions[start:], None
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        page = positions[start:start + limit]
+        has_more = start + limit < len(positions)
+        return page, encode_cursor(self.keys[page[-1]]) if has_more and len(page) else None
+
+cached_catalogues = {}  # dataset id -> (content hash, mapping, Catalogue)
+cache_lock = threading.Lock()
+
+def get_catalogue(dataset, mapping):
+    """Catalogue of a dataset snapshot, rebuilt only when the dataset version or mapping changes."""
+    with cache_lock:
+        cached = cached_catalogues.get(dataset["id"])
+    if cached is not None and cached[0] == dataset["content_hash"] and cached[1] is mapping:
+        return cached[2]
+    catalogue = Catalogue(dataset["id"], dataset["files"], mapping)
+    with cache_lock:
+        cached_catalogues[dataset["id"]] = (dataset["content_hash"], mapping, catalogue)
+    return catalogue
@@ -0,0 +1,125 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import dataset_store
+
+MEMORY_BUDGET = 2 * 1024 ** 3  # Bytes of index arrays kept resident across all loaded datasets
+# Mapped arrays that queries barely touch, so they stay on disk: exact_features is read for a handful of rows
+# per query, and the image model's pixels only by incremental ingest
+COLD_ARRAYS = {"exact_features", "pixels"}
+
+def is_valid_dataset_id(dataset_id):
+    """Dataset ids are plain folder names under the datasets root."""
+    return bool(dataset_id) and os.path.basename(dataset_id) == dataset_id and not dataset_id.startswith(".")
+
+def index_size(stored):
+    """Bytes held by the arrays of a stored dataset (mapped pages count in full, cold arrays not at all)."""
+    size = 0
+    for part in ("feature_index", "image_model", "ivf_index", "melody_index"):
+        for name, value in (stored.get(part) or {}).items():
+            if isinstance(value, np.ndarray) and name not in COLD_ARRAYS:
+                size += value.nbytes
+    return size
+
+def make_dataset(dataset_id, dataset_path, stored):
+    """Snapshot of one dataset version, as handed to queries."""
+    dataset = dict(stored)
+    dataset.update(id=dataset_id, path=dataset_path, size_bytes=index_size(stored))
+    return dataset
+
+class DatasetRegistry:
+    """Datasets under one root, loaded on first use and evicted least-recently-used first.
+
+    Each loaded dataset is an immutable snapshot dict. `publish` swaps in a new
+    snapshot in one step, so queries that already hold the old one finish on
+    it and later ones see the rebuilt indexes; nothing ever sees a half-built
+    dataset.
+    """
+
+    def __init__(self, datasets_root, memory_budget=MEMORY_BUDGET):
+        self.datasets_root = datasets_root
+        self.memory_budget = memory_budget
+        self.loaded = OrderedDict()
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()  # Serializes cold loads, so a dataset is never loaded twice at once
+
+    def get_path(self, dataset_id):
+        return os.path.join(self.datasets_root, dataset_id)
+
+    def get(self, dataset_id):
+        """Snapshot of a dataset, loading it from its feature store if needed; None if unknown.
+
+        A cold load maps files and builds indexes, so callers on the event loop should
+        run this on an executor. Only other cold loads wait for it.
+        """
+        if not is_valid_dataset_id(dataset_id):
+            return None
+        dataset = self.get_resident(dataset_id)
+        if dataset is not None:
+            return dataset
+
+        with self.load_lock:
+            # Another request may have loaded it while this one waited
+            dataset = self.get_resident(dataset_id)
+            if dataset is not None:
+                return dataset
+            dataset_path = self.get_path(dataset_id)
+            stored = dataset_store.load_latest(dataset_path) if os.path.isdir(dataset_path) else None
+            if stored is None:
+                return None
+            dataset = make_dataset(dataset_id, dataset_path, stored)
+            with self.lock:
+                # A publish that landed during the load is newer than what was read from disk
+                if dataset_id in self.loaded:
+                    return self.loaded[dataset_id]
+                self._insert(dataset)
+        print(f"Loaded dataset {dataset_id} ({dataset['size_bytes'] / 1024 ** 2:.1f} MiB of indexes).")
+        return dataset
+
+    def get_resident(self, dataset_id):
+        """Snapshot of a dataset if it is already loaded, else None; never touches the disk."""
+        with self.lock:
+            dataset = self.loaded.get(dataset_id)
+            if dataset is not None:
+                self.loaded.move_to_end(dataset_id)
+            return dataset
+
+    def publish(self, dataset_id, stored):
+        """Atomically make `stored` (from dataset_store) the version of `dataset_id` answering queries."""
+        dataset = make_dataset(dataset_id, self.get_path(dataset_id), stored)
+        with self.lock:
+            self._insert(dataset)
+        return dataset
+
+    def evict(self, dataset_id):
+        with self.lock:
+            self.loaded.pop(dataset_id, None)
+
+    def loaded_datasets(self):
+        """Resident snapshots, least recently used first; looking does not count as a use."""
+        with self.lock:
+            return list(self.loaded.values())
+
+    def list_datasets(self):
+        """Every dataset on disk that has a feature store, with whether it is resident."""
+        if not os.path.isdir(self.datasets_root):
+            return []
+        with self.lock:
+            loaded = {dataset_id: dataset["size_bytes"] for dataset_id, dataset in self.loaded.items()}
+        datasets = []
+        for entry in sorted(os.listdir(self.datasets_root)):
+            store_root = os.path.join(self.datasets_root, entry, dataset_store.STORE_DIRECTORY)
+            if is_valid_dataset_id(entry) and os.path.isdir(store_root):
+                datasets.append({"id": entry, "loaded": entry in loaded, "size_bytes": loaded.get(entry)})
+        return datasets
+
+    def _insert(self, dataset):
+        self.loaded.pop(dataset["id"], None)
+        self.loaded[dataset["id"]] = dataset
+        # Always keep the newest dataset, even if it alone exceeds the budget
+        total = sum(loaded["size_bytes"] for loaded in self.loaded.values())
+        while total > self.memory_budget and len(self.loaded) > 1:
+            evicted_id, evicted = self.loaded.popitem(last=False)
+            total -= evicted["size_bytes"]
+            print(f"Evicted dataset {evicted_id} to stay within the memory budget.")
@@ -0,0 +1,230 @@
+import os
+import json
+import shutil
+import hashlib
+import time
+import numpy as np
+import ann_index
+import ngram_index
+
+STORE_VERSION = 7  # Bump whenever the stored feature layout changes
+STORE_DIRECTORY = ".store"
+CURRENT_POINTER = "current.json"
+VERSION_POINTER = "current.json"  # Inside a dataset's store: which stored version is the published one
+HASH_CHUNK_SIZE = 1 << 20
+
+FEATURE_ARRAYS = ["features", "feature_scales", "exact_features", "song_errors", "envelopes", "offsets", "counts",
+                  "notes", "note_offsets", "note_counts"]  # feature_scales and exact_features are None for float32 indexes
+IMAGE_ARRAYS = ["pixels", "mean_dataset", "eigenvectors", "singular_values", "projected_dataset"]
+
+def hash_file(file_path):
+    """SHA-1 of a file's bytes, read in chunks."""
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def compute_content_hash(files):
+    """Combine per-file fingerprints ({relative path: [size, mtime, sha1]}) into one dataset hash."""
+    digest = hashlib.sha1()
+    for relative_path in sorted(files):
+        digest.update(f"{relative_path}\0{files[relative_path][2]}\n".encode())
+    return digest.hexdigest()
+
+def get_store_path(dataset_path, content_hash):
+    """Directory holding the stored features of one dataset version."""
+    return os.path.join(dataset_path, STORE_DIRECTORY, f"v{STORE_VERSION}-{content_hash}")
+
+def save_dataset(dataset_path, content_hash, files, feature_index, image_model, ivf_index=None, melody_index=None):
+    """Write the file fingerprints, MIDI features, image PCA model and optional search indexes of a dataset to its versioned store."""
+    store_path = get_store_path(dataset_path, content_hash)
+    temp_path = f"{store_path}.tmp"
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+
+    arrays = {name: feature_index[name] for name in FEATURE_ARRAYS if feature_index[name] is not None}
+    if image_model is not None:
+        arrays.update({name: image_model[name] for name in IMAGE_ARRAYS})
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_path, f"{name}.npy"), np.asarray(array))
+    if ivf_index is not None:
+        ann_index.save_ivf_index(ivf_index, os.path.join(temp_path, "ivf"))
+    if melody_index is not None:
+        ngram_index.save_ngram_index(melody_index, os.path.join(temp_path, "ngram"))
+
+    manifest = {
+        "version": STORE_VERSION,
+        "content_hash": content_hash,
+        "created_at": time.time(),
+        "files": files,
+        "song_names": list(feature_index["song_names"]),
+        "image_model": None if image_model is None else {
+            "image_names": list(image_model["image_names"]),
+            "fit_size": int(image_model["fit_size"]),
+            "changes_since_fit": int(image_model["changes_since_fit"]),
+        },
+        "arrays": sorted(arrays),
+        "ivf_index": ivf_index is not None,
+        "melody_index": melody_index is not None,
+    }
+    with open(os.path.join(temp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+    # Swap the finished directory in, point at it, then drop stale versions. The version it replaces
+    # is kept until the next publish, as queries that started before the swap may still read it.
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(temp_path, store_path)
+    store_root = os.path.dirname(store_path)
+    version = os.path.basename(store_path)
+    published, previous = read_version_pointer(store_root) or (None, None)
+    if published != version:
+        previous = published
+    write_version_pointer(store_root, version, previous)
+    prune_versions(store_root, {version, previous})
+    return store_path
+
+def write_version_pointer(store_root, version, previous=None):
+    """Atomically record `version` (a store entry name) as the published version of a dataset,
+    and `previous` as the one it replaced, which is spared from pruning until the next publish."""
+    pointer_path = os.path.join(store_root, VERSION_POINTER)
+    with open(f"{pointer_path}.tmp", "w") as f:
+        json.dump({"version": version, "previous": previous}, f)
+    os.replace(f"{pointer_path}.tmp", pointer_path)
+
+def read_version_pointer(store_root):
+    """(published version, previous version) from the store's pointer, or None."""
+    pointer_path = os.path.join(store_root, VERSION_POINTER)
+    try:
+        with open(pointer_path, "r") as f:
+            pointer = json.load(f)
+        return pointer["version"], pointer.get("previous")
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def prune_versions(store_root, keep):
+    """Delete every stored version directory of a dataset except those named in `keep`.
+
+    Failures are ignored (e.g. files still mapped on Windows); load_latest goes by
+    the version pointer, so a leftover version is never mistaken for the current one.
+    """
+    for entry in os.listdir(store_root):
+        entry_path = os.path.join(store_root, entry)
+        # .tmp directories belong to a save still in progress
+        if entry not in keep and not entry.endswith(".tmp") and os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+def stored_versions(store_root):
+    """Complete stored versions of the current layout as {entry name: manifest created_at}."""
+    prefix = f"v{STORE_VERSION}-"
+    versions = {}
+    for entry in os.listdir(store_root):
+        if not entry.startswith(prefix) or entry.endswith(".tmp"):
+            continue
+        try:
+            with open(os.path.join(store_root, entry, "manifest.json"), "r") as f:
+                versions[entry] = json.load(f).get("created_at", 0)
+        except (OSError, ValueError):
+            continue
+    return versions
+
+def load_dataset(dataset_path, content_hash):
+    """Memory-map a stored dataset version, or return None if it is missing or outdated."""
+    store_path = get_store_path(dataset_path, content_hash)
+    manifest_path = os.path.join(store_path, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != STORE_VERSION:
+            return None
+        arrays = {
+            name: np.load(os.path.join(store_path, f"{name}.npy"), mmap_mode="r")
+            for name in manifest["arrays"]
+        }
+        ivf_index = ann_index.load_ivf_index(os.path.join(store_path, "ivf")) if manifest.get("ivf_index") else None
+        melody_index = ngram_index.load_ngram_index(os.path.join(store_path, "ngram")) if manifest.get("melody_index") else None
+    except Exception as e:
+        print(f"Error loading stored dataset {store_path}: {e}")
+        return None
+
+    feature_index = {name: arrays.get(name) for name in FEATURE_ARRAYS}
+    feature_index["song_names"] = manifest["song_names"]
+    # Lets worker processes map the same arrays instead of receiving copies
+    feature_index["store_path"] = store_path
+    image_model = None
+    if manifest["image_model"] is not None:
+        image_model = {name: arrays[name] for name in IMAGE_ARRAYS}
+        image_model.update(manifest["image_model"])
+    return {
+        "content_hash": manifest["content_hash"],
+        "files": manifest["files"],
+        "feature_index": feature_index,
+        "image_model": image_model,
+        "ivf_index": ivf_index,
+        "melody_index": melody_index,
+    }
+
+def load_feature_index(store_path):
+    """Memory-map just the MIDI feature arrays of a stored dataset version (song names excluded)."""
+    with open(os.path.join(store_path, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    feature_index = {
+        name: np.load(os.path.join(store_path, f"{name}.npy"), mmap_mode="r") if name in manifest["arrays"] else None
+        for name in FEATURE_ARRAYS
+    }
+    feature_index["store_path"] = store_path
+    return feature_index
+
+def load_latest(dataset_path):
+    """Load the published version of a dataset, whatever its content hash.
+
+    That is the version named by the store's pointer, or, if the pointer is missing
+    or broken, the most recently created one. Other versions left behind by an
+    interrupted prune are deleted, except the one the published version replaced.
+    """
+    store_root = os.path.join(dataset_path, STORE_DIRECTORY)
+    if not os.path.isdir(store_root):
+        return None
+    versions = stored_versions(store_root)
+    pointed, previous = read_version_pointer(store_root) or (None, None)
+    candidates = sorted(versions, key=lambda entry: (entry == pointed, versions[entry]), reverse=True)
+    prefix = f"v{STORE_VERSION}-"
+    for entry in candidates:
+        stored = load_dataset(dataset_path, entry[len(prefix):])
+        if stored is not None:
+            if entry != pointed:
+                write_version_pointer(store_root, entry, previous)
+            prune_versions(store_root, {entry, previous})
+            return stored
+    return None
+
+def save_current(datasets_root, dataset_path, content_hash, mapper_path=None):
+    """Remember which dataset (and mapper file) to restore on the next startup."""
+    os.makedirs(datasets_root, exist_ok=True)
+    pointer_path = os.path.join(datasets_root, CURRENT_POINTER)
+    with open(f"{pointer_path}.tmp", "w") as f:
+        json.dump({"dataset_path": dataset_path, "content_hash": content_hash, "mapper_path": mapper_path}, f)
+    os.replace(f"{pointer_path}.tmp", pointer_path)
+
+def load_current(datasets_root):
+    """Read the startup pointer written by save_current, if any."""
+    pointer_path = os.path.join(datasets_root, CURRENT_POINTER)
+    if not os.path.exists(pointer_path):
+        return None
+    try:
+        with open(pointer_path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading {pointer_path}: {e}")
+        return None
+
+def clear_current(datasets_root):
+    """Forget the startup pointer so nothing is restored on the next startup."""
+    pointer_path = os.path.join(datasets_root, CURRENT_POINTER)
+    if os.path.exists(pointer_path):
+        os.remove(pointer_path)
@@ -0,0 +1,84 @@
+import os
+import queue
+import asyncio
+import functools
+import contextlib
+import contextvars
+import concurrent.futures
+import metrics
+
+UPLOAD_CHUNK_SIZE = 1 << 20  # Bytes read from a request body per await
+
+# Query scoring is numpy-heavy and releases the GIL, so threads are enough; ingests run one at a time
+query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="query")
+ingest_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+file_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="file-io")
+
+async def run_in_executor(executor, function, *args, **kwargs):
+    """Run a blocking call on `executor` without blocking the event loop.
+
+    The call sees the caller's context, so stage timers and the profiler of the
+    current request follow it onto the worker thread.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, metrics.profiled, function, *args, **kwargs))
+
+async def save_upload(upload_file, file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Stream an UploadFile to disk chunk by chunk; returns the bytes written."""
+    f = await run_in_executor(file_executor, open, file_path, "wb")
+    size = 0
+    try:
+        while True:
+            chunk = await upload_file.read(chunk_size)
+            if not chunk:
+                break
+            await run_in_executor(file_executor, f.write, chunk)
+            size += len(chunk)
+    finally:
+        await run_in_executor(file_executor, f.close)
+    return size
+
+class EndpointLimiter:
+    """Caps how many requests of one endpoint run at once.
+
+    Up to `max_queued` further requests wait for a slot; beyond that the caller
+    gets queue.Full so it can answer 503 instead of piling up work.
+    """
+
+    def __init__(self, max_concurrent, max_queued):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.admitted = 0  # Running plus waiting
+
+    def slot(self):
+        """Reserve a place for one request, to be held with `async with`.
+
+        Raises queue.Full immediately when the endpoint is saturated, before
+        anything is awaited.
+        """
+        if self.admitted >= self.max_concurrent + self.max_queued:
+            raise queue.Full
+        self.admitted += 1
+        return self._hold()
+
+    @contextlib.asynccontextmanager
+    async def _hold(self):
+        try:
+            async with self.semaphore:
+                yield
+        finally:
+            self.admitted -= 1
+
+    def stats(self):
+        return {
+            "running": min(self.admitted, self.max_concurrent),
+            "queued": max(0, self.admitted - self.max_concurrent),
+            "max_concurrent": self.max_concurrent,
+            "max_queued": self.max_queued,
+        }
+
+def shutdown():
+    for executor in (query_executor, ingest_executor, file_executor):
+        executor.shutdown(wait=False, cancel_futures=True)
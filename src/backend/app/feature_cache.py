@@ -0,0 +1,192 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+CACHE_VERSION = 1  # Bump whenever get_feature or the note parser changes what gets cached
+MAX_CACHE_ENTRIES = 4096
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+MAX_DISK_BYTES = 2 * 1024 ** 3  # Bytes of .npz files kept by the on-disk tier
+DISK_PRUNE_TARGET = 0.9  # Pruning frees the disk tier down to this fraction of its cap, so it doesn't run on every write
+FEATURE_NAMES = ["atb", "rtb", "ftb", "notes"]
+
+def content_key(data):
+    """Cache key of a MIDI file's bytes."""
+    return hashlib.sha1(data).hexdigest()
+
+class FeatureCache:
+    """LRU cache of MIDI features (ATB, RTB, FTB, notes) keyed by the SHA-1 of the file's bytes.
+
+    The in-memory tier is bounded by entry count and total array bytes. When a
+    directory is set, entries are also written there as .npz files so other
+    processes and later runs can reuse them; that tier is bounded by total file
+    bytes, dropping the least recently used files (by mtime) first.
+    """
+
+    def __init__(self, max_entries=MAX_CACHE_ENTRIES, max_bytes=MAX_CACHE_BYTES, directory=None,
+                 max_disk_bytes=MAX_DISK_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_bytes = None  # Counted from the directory on the first write
+        self.disk_lock = threading.Lock()
+        self.disk_evictions = 0
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Cached features for `key`, or None."""
+        with self.lock:
+            features = self.entries.get(key)
+            if features is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return features
+
+        features = self._read_disk(key)
+        with self.lock:
+            if features is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, features)
+        return features
+
+    def put(self, key, features):
+        """Store features for `key` in memory and, if enabled, on disk."""
+        features = tuple(np.asarray(array) for array in features)
+        for array in features:
+            array.setflags(write=False)
+        with self.lock:
+            self._insert(key, features)
+        self._write_disk(key, features)
+
+    def use_directory(self, directory):
+        """Enable (or move) the on-disk tier."""
+        with self.disk_lock:
+            self.directory = directory
+            self.disk_bytes = None
+
+    def clear(self):
+        """Drop the in-memory tier and reset the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.size_bytes = 0
+            self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_bytes": self.disk_bytes or 0,
+                "disk_evictions": self.disk_evictions,
+                "disk_tier": self.directory is not None,
+            }
+
+    def _insert(self, key, features):
+        if key in self.entries:
+            self.size_bytes -= sum(array.nbytes for array in self.entries.pop(key))
+        size = sum(array.nbytes for array in features)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = features
+        self.size_bytes += size
+        while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size_bytes -= sum(array.nbytes for array in evicted)
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, f"v{CACHE_VERSION}", key[:2], f"{key}.npz")
+
+    def _read_disk(self, key):
+        if self.directory is None:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as stored:
+                features = tuple(stored[name] for name in FEATURE_NAMES)
+        except Exception as e:
+            print(f"Error reading cached features {path}: {e}")
+            return None
+        for array in features:
+            array.setflags(write=False)
+        try:
+            # Reads count as uses, so pruning drops the files that went unused longest
+            os.utime(path)
+        except OSError:
+            pass
+        return features
+
+    def _write_disk(self, key, features):
+        if self.directory is None:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Unique temporary name so concurrent writers never clobber each other mid-write
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                np.savez(f, **dict(zip(FEATURE_NAMES, features)))
+            os.replace(temp_path, path)
+            size = os.path.getsize(path)
+        except Exception as e:
+            print(f"Error writing cached features {path}: {e}")
+            return
+
+        with self.disk_lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(file_size for _, _, file_size in self._disk_files())
+            else:
+                self.disk_bytes += size
+            if self.disk_bytes > self.max_disk_bytes:
+                self._prune_disk()
+
+    def _disk_files(self):
+        """(mtime, path, size) of every cached .npz file, whatever its cache version."""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".npz"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, path, stat.st_size))
+        return files
+
+    def _prune_disk(self):
+        # Called with disk_lock held; recounts from the directory, as other processes may share it
+        files = sorted(self._disk_files())
+        total = sum(size for _, _, size in files)
+        target = self.max_disk_bytes * DISK_PRUNE_TARGET
+        for _, path, size in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.disk_evictions += 1
+        self.disk_bytes = total
+
+# Cache shared by ingestion and queries in the API process
+shared_cache = FeatureCache()
@@ -1,68 +1,154 @@
 from PIL import Image
 import numpy as np
 import os
+import io
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from scipy.sparse.linalg import svds  # Truncated SVD
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import ann_index
+import metrics
 
 IMAGE_SIZE = (64, 64)  # Image resize dimensions
+IMAGE_PIXELS = IMAGE_SIZE[0] * IMAGE_SIZE[1]
 N_COMPONENTS = 50  # Number of principal components to retain
+REFIT_THRESHOLD = 0.25  # Fraction of changed images that triggers a full PCA refit
+IMAGE_EXECUTOR_MODE = "process"  # "process" sidesteps the GIL during decode and resize, "thread" avoids worker startup
+IMAGE_BATCH_SIZE = 64  # Images decoded per worker task
+SVD_OVERSAMPLES = 10  # Extra random directions in the randomized range finder
+SVD_POWER_ITERATIONS = 4  # Power iterations sharpening the range estimate
+SVD_CHUNK_SIZE = 2048  # Rows converted to float32 at a time
+FIT_SAMPLE_SIZE = 50000  # Larger datasets fit the basis on a random sample of this many images
 
 image_names = []
 image_files = []
 
+def load_image(source):
+    """Decode an image straight to a grayscale IMAGE_SIZE picture, shrinking it as early as possible."""
+    with Image.open(source) as img:
+        # JPEGs are downscaled in the DCT domain and decoded to grayscale directly
+        img.draft("L", IMAGE_SIZE)
+        img_gray = img.convert("L")
+
+    # Cheap box reduction down to at most twice the target before the final resample
+    factor = min(img_gray.width // IMAGE_SIZE[0], img_gray.height // IMAGE_SIZE[1]) // 2
+    if factor >= 2:
+        img_gray = img_gray.reduce(factor)
+    return img_gray.resize(IMAGE_SIZE)
+
 def process_image(image_path):
     """Helper function to process an image: resize and flatten."""
     try:
-        with Image.open(image_path) as img:
-            img_gray = img.convert("L")
-            img_resized = img_gray.resize(IMAGE_SIZE)
-            return np.array(img_resized).flatten()
+        return np.asarray(load_image(image_path), dtype=np.uint8).flatten()
     except Exception as e:
         print(f"Error processing image {image_path}: {e}")
         return None
 
-def process_dataset_concurrently(directory, max_workers=8):
-    """Process the dataset concurrently using a thread pool."""
+def process_image_bytes(data):
+    """Process an image held in memory, e.g. a ZIP member."""
+    return process_image(io.BytesIO(data))
+
+def process_image_batch(image_paths):
+    """Process a chunk of images into one uint8 matrix plus a mask of the rows that decoded."""
+    batch = np.zeros((len(image_paths), IMAGE_PIXELS), dtype=np.uint8)
+    valid = np.zeros(len(image_paths), dtype=bool)
+    for i, image_path in enumerate(image_paths):
+        pixels = process_image(image_path)
+        if pixels is not None:
+            batch[i] = pixels
+            valid[i] = True
+    return batch, valid
+
+def create_image_executor(mode=IMAGE_EXECUTOR_MODE, max_workers=None):
+    """Executor for image decoding, sized to the CPU count by default."""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if mode == "process":
+        # Spawned, not forked: ingests run on a thread of the server process
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+def process_image_files_concurrently(image_files, max_workers=None, mode=IMAGE_EXECUTOR_MODE):
+    """Process a list of image files in chunked batches into one preallocated uint8 matrix.
+
+    Names and rows keep the order of `image_files`; files that fail to decode are dropped.
+    """
+    processed_images = np.zeros((len(image_files), IMAGE_PIXELS), dtype=np.uint8)
+    valid = np.zeros(len(image_files), dtype=bool)
+    if not image_files:
+        return [], processed_images
+
+    workers = max_workers or os.cpu_count() or 1
+    batch_size = max(1, min(IMAGE_BATCH_SIZE, -(-len(image_files) // workers)))
+    with create_image_executor(mode, workers) as executor:
+        futures = {
+            executor.submit(process_image_batch, image_files[start:start + batch_size]): start
+            for start in range(0, len(image_files), batch_size)
+        }
+        for future in as_completed(futures):
+            start = futures[future]
+            batch, batch_valid = future.result()
+            processed_images[start:start + len(batch)] = batch
+            valid[start:start + len(batch)] = batch_valid
+
+    names = [os.path.basename(file) for file, decoded in zip(image_files, valid) if decoded]
+    if not np.all(valid):
+        processed_images = processed_images[valid]
+    return names, processed_images
+
+def process_dataset_concurrently(directory, max_workers=None):
+    """Process the dataset concurrently using the configured image executor."""
     global image_names, image_files
     image_files = []
-    image_names = []
-    processed_images = []
-    path_to_title = {}
 
     # Collect all image files
     for root, _, files in os.walk(directory):
         for file in files:
             if file.lower().endswith((".jpg", ".png", ".jpeg")):
-                file_path = os.path.join(root, file)
-                image_files.append(file_path)
-                path_to_title[file_path] = file
-
-    # Process images in parallel
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_file = {executor.submit(process_image, file): file for file in image_files}
-        for future in as_completed(future_to_file):
-            result = future.result()
-            if result is not None:
-                processed_images.append(result)
-                image_names.append(path_to_title[future_to_file[future]])
-
-    return np.array(processed_images)
-
-def standardize_dataset(processed_dataset):
-    """Standardize the dataset (zero-mean)."""
-    mean_dataset = np.mean(processed_dataset, axis=0)
-    standardized_dataset = processed_dataset - mean_dataset
-    return standardized_dataset, mean_dataset
-
-def perform_truncated_svd(standardized_dataset, n_components):
-    """Perform Truncated SVD to reduce dimensionality."""
-    print("Performing truncated SVD...")
-    # Compute only the top `n_components` singular values/vectors
-    U, S, Vt = svds(standardized_dataset, k=n_components)
-    eigenvectors = Vt.T  # Use right singular vectors (V)
-    projected_dataset = np.dot(standardized_dataset, eigenvectors)
-    return eigenvectors, projected_dataset
+                image_files.append(os.path.join(root, file))
+
+    image_names, processed_images = process_image_files_concurrently(image_files, max_workers)
+    return processed_images
+
+def compute_mean(pixels, chunk_size=SVD_CHUNK_SIZE):
+    """Column mean of a uint8 pixel matrix, accumulated in chunks."""
+    total = np.zeros(pixels.shape[1])
+    for start in range(0, len(pixels), chunk_size):
+        total += np.sum(pixels[start:start + chunk_size], axis=0, dtype=float)
+    return (total / len(pixels)).astype(np.float32)
+
+def centered_dot(pixels, mean, matrix, chunk_size=SVD_CHUNK_SIZE):
+    """(pixels - mean) @ matrix without materializing the centered copy."""
+    result = np.empty((len(pixels), matrix.shape[1]), dtype=np.float32)
+    offset = mean @ matrix
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start + chunk_size].astype(np.float32)
+        result[start:start + len(chunk)] = chunk @ matrix - offset
+    return result
+
+def centered_transpose_dot(pixels, mean, matrix, chunk_size=SVD_CHUNK_SIZE):
+    """(pixels - mean).T @ matrix without materializing the centered copy."""
+    result = np.zeros((pixels.shape[1], matrix.shape[1]), dtype=np.float32)
+    for start in range(0, len(pixels), chunk_size):
+        result += pixels[start:start + chunk_size].astype(np.float32).T @ matrix[start:start + chunk_size]
+    return result - np.outer(mean, np.sum(matrix, axis=0))
+
+def randomized_svd(pixels, mean, n_components, n_oversamples=SVD_OVERSAMPLES, n_iter=SVD_POWER_ITERATIONS, seed=0):
+    """Top singular values and right singular vectors of the centered pixels (Halko et al., 2011).
+
+    Works in float32 and only ever holds a few (rows x components) blocks besides
+    the uint8 pixels.
+    """
+    rng = np.random.default_rng(seed)
+    rank = min(n_components + n_oversamples, *pixels.shape)
+    sketch = centered_dot(pixels, mean, rng.standard_normal((pixels.shape[1], rank), dtype=np.float32))
+    for _ in range(n_iter):
+        # Re-orthonormalize between products so small singular directions are not lost
+        basis, _ = np.linalg.qr(sketch)
+        right, _ = np.linalg.qr(centered_transpose_dot(pixels, mean, basis))
+        sketch = centered_dot(pixels, mean, right)
+    basis, _ = np.linalg.qr(sketch)
+    _, singular_values, Vt = np.linalg.svd(centered_transpose_dot(pixels, mean, basis).T, full_matrices=False)
+    return singular_values[:n_components], np.ascontiguousarray(Vt[:n_components].T)
 
 def process_query_image(image_path):
     """Process a query image (resize and flatten)."""
@@ -84,38 +170,170 @@ def cosine_similarity(vec1, vec2):
         return 0.0
     return np.dot(vec1, vec2) / (norm1 * norm2)
 
-def query_image(query_image_path, eigenvectors, projected_dataset, mean_dataset):
-    """Query the dataset with a new image and find the most similar ones."""
-    processed_query = process_query_image(query_image_path)
+def normalize_rows(matrix):
+    """L2-normalize each row, leaving all-zero rows untouched."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def rank_similarities(similarities, top_k=None, threshold=None):
+    """Indices of the best similarities in descending order, cut to `top_k` and/or above `threshold`."""
+    candidates = np.arange(len(similarities))
+    if threshold is not None:
+        candidates = np.flatnonzero(similarities > threshold)
+    if top_k is not None and top_k < len(candidates):
+        best = np.argpartition(-similarities[candidates], top_k - 1)[:top_k]
+        candidates = candidates[best]
+    return candidates[np.argsort(-similarities[candidates], kind="stable")]
+
+def query_image(query_image_path, eigenvectors, projected_dataset, mean_dataset, top_k=None, threshold=None,
+                index=None, nprobe=ann_index.DEFAULT_NPROBE):
+    """Query the dataset with a new image and find the most similar ones.
+
+    `projected_dataset` holds L2-normalized rows, so one matrix-vector product gives
+    the cosine similarity to every image. The returned indices are sorted in
+    descending order and limited to `top_k` and/or `threshold` when given.
+    With an IVF `index` only its `nprobe` closest lists are scanned, and images
+    outside them get a similarity of 0.
+    """
+    with metrics.stage("decode"):
+        processed_query = process_query_image(query_image_path)
     if processed_query is None:
         return None, None
+    return query_processed_image(processed_query, eigenvectors, projected_dataset, mean_dataset, top_k, threshold, index, nprobe)
+
+def query_processed_image(processed_query, eigenvectors, projected_dataset, mean_dataset, top_k=None, threshold=None,
+                          index=None, nprobe=ann_index.DEFAULT_NPROBE):
+    """Like query_image, for a query already decoded with process_query_image."""
+    with metrics.stage("scoring"):
+        standardized_query = processed_query - mean_dataset
+        projected_query = np.dot(standardized_query, eigenvectors)
 
-    standardized_query = processed_query - mean_dataset
-    projected_query = np.dot(standardized_query, eigenvectors)
+        # Compute similarities (cosine similarity)
+        query_norm = np.linalg.norm(projected_query)
+        candidate_ids = None
+        if query_norm == 0:
+            similarities = np.zeros(len(projected_dataset))
+        elif index is not None:
+            candidate_ids, candidate_scores = ann_index.search_ivf_index(index, projected_query / query_norm, nprobe)
+            similarities = np.zeros(len(projected_dataset))
+            similarities[candidate_ids] = candidate_scores
+        else:
+            similarities = np.dot(projected_dataset, projected_query / query_norm)
 
-    # Compute similarities (cosine similarity)
-    similarities = np.array([
-        cosine_similarity(projected_query, projected_dataset[i])
-        for i in range(len(projected_dataset))
-    ])
-    sorted_indices = np.argsort(similarities)[::-1]  # Sort in descending order
+    with metrics.stage("ranking"):
+        if candidate_ids is not None:
+            return similarities, candidate_ids[rank_similarities(candidate_scores, top_k, threshold)]
+        sorted_indices = rank_similarities(similarities, top_k, threshold)
     return similarities, sorted_indices
 
 def initialize_dataset_concurrently(directory):
     """Initialize the dataset with concurrent processing."""
     processed_dataset = process_dataset_concurrently(directory)
-    standardized_dataset, mean_dataset = standardize_dataset(processed_dataset)
-    eigenvectors, projected_dataset = perform_truncated_svd(
-        standardized_dataset, min(N_COMPONENTS, len(processed_dataset) - 1))
-    return eigenvectors, projected_dataset, mean_dataset
-
-def get_similarities(similarities, sorted_indices, threshold = 0.7):
-    """Get similar images based on threshold."""
-    similar_images = []
-    for i in range(len(sorted_indices)):
-        if similarities[sorted_indices[i]] > threshold:
-            similar_images.append((image_names[sorted_indices[i]], similarities[sorted_indices[i]]))
-    return similar_images
+    model = fit_image_model(image_names, processed_dataset)
+    return model["eigenvectors"], model["projected_dataset"], model["mean_dataset"]
+
+def get_similarities(similarities, sorted_indices, threshold = 0.7, names=None):
+    """Get similar images based on threshold; `names` defaults to the module's image_names."""
+    names = image_names if names is None else names
+    selected = sorted_indices[similarities[sorted_indices] > threshold]
+    return [(names[i], similarities[i]) for i in selected]
+
+def project_dataset(processed_dataset, mean_dataset, eigenvectors, chunk_size=SVD_CHUNK_SIZE):
+    """Project raw pixel rows onto the eigenvectors in chunks and L2-normalize them."""
+    eigenvectors = np.asarray(eigenvectors, dtype=np.float32)
+    return normalize_rows(centered_dot(processed_dataset, np.asarray(mean_dataset, dtype=np.float32), eigenvectors, chunk_size))
+
+def fit_image_model(names, processed_dataset, sample_size=FIT_SAMPLE_SIZE, seed=0):
+    """Fit the PCA model from scratch and keep what incremental updates need.
+
+    With more than `sample_size` images the basis is fitted on a random sample
+    and every image is then projected in chunks.
+    """
+    if len(processed_dataset) < 2:
+        return None
+
+    print("Performing randomized SVD...")
+    pixels = np.asarray(processed_dataset, dtype=np.uint8)
+    mean_dataset = compute_mean(pixels)
+    n_components = min(N_COMPONENTS, len(pixels) - 1)
+    if sample_size is not None and len(pixels) > sample_size:
+        sample = np.sort(np.random.default_rng(seed).choice(len(pixels), sample_size, replace=False))
+        _, eigenvectors = randomized_svd(pixels[sample], mean_dataset, n_components, seed=seed)
+    else:
+        _, eigenvectors = randomized_svd(pixels, mean_dataset, n_components, seed=seed)
+
+    projected_dataset = centered_dot(pixels, mean_dataset, eigenvectors)
+    return {
+        "image_names": list(names),
+        "pixels": pixels,
+        "mean_dataset": mean_dataset,
+        "eigenvectors": eigenvectors,
+        # Columns of U * S over the whole dataset, so their norms are its singular values
+        "singular_values": np.linalg.norm(projected_dataset, axis=0),
+        "projected_dataset": normalize_rows(projected_dataset),
+        "fit_size": len(pixels),
+        "changes_since_fit": 0,
+    }
+
+def update_image_model(model, added_names, added_images, removed_names=()):
+    """Fold added and removed images into the PCA model with an incremental SVD.
+
+    Falls back to a full refit once the images changed since the last fit exceed
+    REFIT_THRESHOLD of the dataset that fit was computed on.
+    """
+    if model is None:
+        return fit_image_model(added_names, added_images)
+
+    removed = set(removed_names) | set(added_names)
+    keep = np.array([name not in removed for name in model["image_names"]], dtype=bool)
+    names = [name for name, kept in zip(model["image_names"], keep) if kept] + list(added_names)
+    old_pixels = np.asarray(model["pixels"])
+    pixels = np.concatenate((old_pixels[keep], np.asarray(added_images, dtype=np.uint8)))
+
+    n_components = min(N_COMPONENTS, len(pixels) - 1)
+    changes_since_fit = model["changes_since_fit"] + len(added_images) + int(np.sum(~keep))
+    if n_components < 1 or changes_since_fit > REFIT_THRESHOLD * model["fit_size"]:
+        return fit_image_model(names, pixels)
+
+    # Remove dropped rows from the mean exactly; the basis keeps them until the next refit
+    n_samples = int(np.sum(keep))
+    mean_dataset = np.asarray(model["mean_dataset"], dtype=float)
+    if n_samples < len(old_pixels):
+        removed_sum = np.sum(old_pixels[~keep], axis=0, dtype=float)
+        mean_dataset = (mean_dataset * len(old_pixels) - removed_sum) / max(n_samples, 1)
+
+    eigenvectors = np.asarray(model["eigenvectors"])
+    singular_values = np.asarray(model["singular_values"])
+    if len(added_images) > 0:
+        # Incremental PCA update (Ross et al., 2008) on the stacked low-rank model and new batch
+        batch = np.asarray(added_images, dtype=float)
+        batch_mean = np.mean(batch, axis=0)
+        n_total = n_samples + len(batch)
+        mean_correction = np.sqrt(n_samples * len(batch) / n_total) * (mean_dataset - batch_mean)
+        stacked = np.vstack((
+            singular_values[:, None] * eigenvectors.T,
+            batch - batch_mean,
+            mean_correction,
+        ))
+        _, singular_values, Vt = np.linalg.svd(stacked, full_matrices=False)
+        singular_values = singular_values[:n_components]
+        eigenvectors = Vt[:n_components].T
+        mean_dataset = (n_samples * mean_dataset + len(batch) * batch_mean) / n_total
+
+    if eigenvectors.shape[1] != n_components:
+        return fit_image_model(names, pixels)
+
+    return {
+        "image_names": names,
+        "pixels": pixels,
+        "mean_dataset": mean_dataset.astype(np.float32),
+        "eigenvectors": eigenvectors.astype(np.float32),
+        "singular_values": singular_values,
+        "projected_dataset": project_dataset(pixels, mean_dataset, eigenvectors),
+        "fit_size": model["fit_size"],
+        "changes_since_fit": changes_since_fit,
+    }
 
 # Main Execution
 if __name__ == "__main__":
@@ -0,0 +1,224 @@
+import os
+import time
+import hashlib
+import zipfile
+import threading
+import multiprocessing
+import concurrent.futures
+import numpy as np
+from tqdm import tqdm
+import midi_processor
+import image_processor
+import dataset_store
+import ann_index
+import ngram_index
+import feature_cache
+
+SONG_EXTENSIONS = (".mid",)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+MAX_PENDING_MEMBERS = 32  # Archive members decoded or queued for decoding at once
+
+def fingerprint_files(dataset_path, previous_files=None):
+    """Fingerprint every song and album file as [size, mtime_ns, sha1].
+
+    Files whose size and mtime match the previous fingerprint reuse its hash
+    instead of being read again.
+    """
+    previous_files = previous_files or {}
+    files = {}
+    for subdirectory, extensions in (("song", SONG_EXTENSIONS), ("album", IMAGE_EXTENSIONS)):
+        directory = os.path.join(dataset_path, subdirectory)
+        if not os.path.isdir(directory):
+            continue
+        for file_name in sorted(os.listdir(directory)):
+            file_path = os.path.join(directory, file_name)
+            if not file_name.lower().endswith(extensions) or not os.path.isfile(file_path):
+                continue
+            stat = os.stat(file_path)
+            relative_path = f"{subdirectory}/{file_name}"
+            previous = previous_files.get(relative_path)
+            if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime_ns:
+                files[relative_path] = previous
+            else:
+                files[relative_path] = [stat.st_size, stat.st_mtime_ns, dataset_store.hash_file(file_path)]
+    return files
+
+def diff_files(previous_files, files):
+    """Split fingerprints into (added or changed, removed or changed) relative paths."""
+    fresh = [path for path, fingerprint in files.items()
+             if path not in previous_files or previous_files[path][2] != fingerprint[2]]
+    stale = [path for path, fingerprint in previous_files.items()
+             if path not in files or files[path][2] != fingerprint[2]]
+    return fresh, stale
+
+def split_by_kind(relative_paths):
+    """Group relative paths into song and album file names."""
+    songs = [path.split("/", 1)[1] for path in relative_paths if path.startswith("song/")]
+    images = [path.split("/", 1)[1] for path in relative_paths if path.startswith("album/")]
+    return songs, images
+
+def remove_untracked_files(dataset_path, files):
+    """Delete song and album files that are not in `files` (relative paths)."""
+    for subdirectory in ("song", "album"):
+        directory = os.path.join(dataset_path, subdirectory)
+        if not os.path.isdir(directory):
+            continue
+        for file_name in os.listdir(directory):
+            if f"{subdirectory}/{file_name}" not in files:
+                os.remove(os.path.join(directory, file_name))
+
+def apply_changes(dataset_path, previous, files, fresh, stale, preprocess_result, added_names, added_images):
+    """Fold processed files into the previous stored dataset and save the result."""
+    content_hash = dataset_store.compute_content_hash(files)
+    stored = dataset_store.load_dataset(dataset_path, content_hash)
+    if stored is not None:
+        return stored
+
+    stale_songs, stale_images = split_by_kind(stale)
+    removed = [path for path in stale if path not in files]
+    print(f"Ingested {len(fresh)} new or changed files, dropped {len(removed)} removed files.")
+
+    if previous:
+        feature_index = midi_processor.update_feature_index(previous["feature_index"], preprocess_result, stale_songs)
+        image_model = image_processor.update_image_model(previous["image_model"], added_names, added_images, stale_images)
+    else:
+        feature_index = midi_processor.build_feature_index(preprocess_result)
+        image_model = image_processor.fit_image_model(added_names, added_images)
+
+    ivf_index = None
+    if image_model is not None and len(image_model["image_names"]) >= ann_index.MIN_INDEX_SIZE:
+        ivf_index = ann_index.build_ivf_index(image_model["projected_dataset"])
+
+    melody_index = ngram_index.build_ngram_index(feature_index)
+
+    dataset_store.save_dataset(dataset_path, content_hash, files, feature_index, image_model, ivf_index, melody_index)
+    return dataset_store.load_dataset(dataset_path, content_hash)
+
+def ingest_dataset(dataset_path, previous=None):
+    """Bring the stored features of a dataset in line with its song and album folders.
+
+    Only files that are new or whose hash changed since `previous` (the stored
+    dataset returned by dataset_store) are processed; removed files are dropped
+    from the MIDI feature index and the image PCA model is updated incrementally.
+    """
+    previous_files = previous["files"] if previous else {}
+    files = fingerprint_files(dataset_path, previous_files)
+    fresh, stale = diff_files(previous_files, files)
+    if not fresh and not stale and previous:
+        return previous
+
+    fresh_songs, fresh_images = split_by_kind(fresh)
+    preprocess_result = midi_processor.process_midi_files_concurrently(
+        [os.path.join(dataset_path, "song", name) for name in fresh_songs],
+        [files[f"song/{name}"][2] for name in fresh_songs])
+    added_names, added_images = image_processor.process_image_files_concurrently(
+        [os.path.join(dataset_path, "album", name) for name in fresh_images])
+    return apply_changes(dataset_path, previous, files, fresh, stale, preprocess_result, added_names, added_images)
+
+def iter_dataset_members(zip_ref):
+    """Yield (ZipInfo, relative dataset path) for the songs and covers in an archive.
+
+    Like the old extract-and-move flow, files are taken from the archive root, or
+    from its single top-level folder when everything is wrapped in one.
+    """
+    members = [info for info in zip_ref.infolist() if not info.is_dir()]
+    top_levels = {info.filename.split("/", 1)[0] for info in members}
+    prefix = ""
+    if len(top_levels) == 1 and all("/" in info.filename for info in members):
+        prefix = f"{top_levels.pop()}/"
+
+    for info in members:
+        if not info.filename.startswith(prefix):
+            continue
+        file_name = info.filename[len(prefix):]
+        if "/" in file_name:
+            continue
+        if file_name.lower().endswith(SONG_EXTENSIONS):
+            yield info, f"song/{file_name}"
+        elif file_name.lower().endswith(IMAGE_EXTENSIONS):
+            yield info, f"album/{file_name}"
+
+def write_member(file_path, data, mtime_ns):
+    """Write one archive member next to its final path, then move it into place."""
+    with open(f"{file_path}.part", "wb") as f:
+        f.write(data)
+    os.utime(f"{file_path}.part", ns=(mtime_ns, mtime_ns))
+    os.replace(f"{file_path}.part", file_path)
+
+def ingest_zip(zip_source, dataset_path, previous=None, append=False):
+    """Stream a dataset ZIP into `dataset_path` one member at a time.
+
+    Each new or changed member is written to the dataset folder and its bytes are
+    handed straight to the MIDI or image feature extractor, with at most
+    MAX_PENDING_MEMBERS members in flight so memory stays flat. Unchanged members
+    are neither written nor decoded. Unless `append` is set, files missing from
+    the archive are removed from the dataset.
+    """
+    previous_files = previous["files"] if previous else {}
+    files = dict(previous_files) if append else {}
+    for subdirectory in ("song", "album"):
+        os.makedirs(os.path.join(dataset_path, subdirectory), exist_ok=True)
+
+    pending = threading.BoundedSemaphore(MAX_PENDING_MEMBERS)
+    futures = []
+    preprocess_result = []
+    # One pool sized to the CPU count decodes songs and covers alike, so the two never oversubscribe the cores;
+    # spawned, not forked, as this runs inside the threaded server
+    with zipfile.ZipFile(zip_source, "r") as zip_ref, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                                   mp_context=multiprocessing.get_context("spawn")) as executor:
+        members = list(iter_dataset_members(zip_ref))
+        image_slots = 0
+        for info, relative_path in members:
+            data = zip_ref.read(info)
+            mtime_ns = int(time.mktime(info.date_time + (0, 0, -1))) * 1_000_000_000
+            fingerprint = [len(data), mtime_ns, hashlib.sha1(data).hexdigest()]
+            file_path = os.path.join(dataset_path, relative_path)
+
+            previous_fingerprint = previous_files.get(relative_path)
+            if previous_fingerprint and previous_fingerprint[2] == fingerprint[2] and os.path.exists(file_path):
+                files[relative_path] = previous_fingerprint
+                continue
+
+            files[relative_path] = fingerprint
+            write_member(file_path, data, mtime_ns)
+
+            file_name = relative_path.split("/", 1)[1]
+            if relative_path.startswith("song/"):
+                # Songs seen before (in any dataset) reuse their cached features
+                cached = feature_cache.shared_cache.get(fingerprint[2])
+                if cached is not None:
+                    preprocess_result.append((file_name,) + cached)
+                    continue
+
+            pending.acquire()
+            if relative_path.startswith("song/"):
+                future = executor.submit(midi_processor.process_midi_bytes, file_name, data)
+            else:
+                future = executor.submit(image_processor.process_image_bytes, data)
+                image_slots += 1
+            future.add_done_callback(lambda _: pending.release())
+            futures.append((relative_path, future))
+
+        # Decoded covers go straight into one preallocated matrix
+        added_names = []
+        added_images = np.zeros((image_slots, image_processor.IMAGE_PIXELS), dtype=np.uint8)
+        for relative_path, future in tqdm(futures, desc="Processing Dataset"):
+            result = future.result()
+            if relative_path.startswith("song/"):
+                if result[0] is not None:
+                    preprocess_result.append((result[0],) + tuple(result[1]))
+                    feature_cache.shared_cache.put(files[relative_path][2], result[1])
+            elif result is not None:
+                added_images[len(added_names)] = result
+                added_names.append(relative_path.split("/", 1)[1])
+        added_images = added_images[:len(added_names)]
+
+    if not append:
+        remove_untracked_files(dataset_path, files)
+
+    fresh, stale = diff_files(previous_files, files)
+    if not fresh and not stale and previous:
+        return previous
+
+    return apply_changes(dataset_path, previous, files, fresh, stale, preprocess_result, added_names, added_images)
@@ -0,0 +1,104 @@
+import sys
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import requests
+
+def timed_request(session, method, url, **kwargs):
+    """Send one request and return (latency in ms, status code)."""
+    start_time = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=120, **kwargs)
+        status = response.status_code
+    except requests.RequestException:
+        status = None
+    return (time.perf_counter() - start_time) * 1000, status
+
+def run_clients(n_clients, send, stop):
+    """Call `send(session)` from `n_clients` threads until `stop` is set; returns every (latency, status)."""
+    samples = []
+    lock = threading.Lock()
+
+    def client():
+        with requests.Session() as session:
+            while not stop.is_set():
+                sample = send(session)
+                with lock:
+                    samples.append(sample)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(n_clients)]
+    for thread in threads:
+        thread.start()
+    return threads, samples
+
+def summarize(samples):
+    latencies = np.array([latency for latency, status in samples if status == 200])
+    report = {
+        "requests": len(samples),
+        "ok": len(latencies),
+        "rejected_503": sum(1 for _, status in samples if status == 503),
+        "errors": sum(1 for _, status in samples if status not in (200, 503)),
+    }
+    if len(latencies):
+        report.update({f"p{q}_ms": float(np.percentile(latencies, q)) for q in (50, 90, 99)})
+        report["max_ms"] = float(latencies.max())
+    return report
+
+def load_test(base_url, image_path, humming_path=None, duration=30.0, gallery_clients=8, image_clients=4, humming_clients=1):
+    """Hammer /gallery/ and /image-query/ while humming queries run in the background.
+
+    Returns latency percentiles per endpoint, so a stalled event loop shows up
+    directly in the gallery and image-query p99.
+    """
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+    humming_bytes = None
+    if humming_path:
+        with open(humming_path, "rb") as f:
+            humming_bytes = f.read()
+
+    def gallery(session):
+        return timed_request(session, "GET", f"{base_url}/gallery/")
+
+    def image_query(session):
+        files = {"file": ("query.jpg", image_bytes, "image/jpeg")}
+        return timed_request(session, "POST", f"{base_url}/image-query/", files=files)
+
+    def humming_query(session):
+        files = {"file": ("humming.wav", humming_bytes, "audio/wav")}
+        return timed_request(session, "POST", f"{base_url}/humming-query/", files=files)
+
+    stop = threading.Event()
+    workers = {
+        "gallery": run_clients(gallery_clients, gallery, stop),
+        "image-query": run_clients(image_clients, image_query, stop),
+    }
+    if humming_bytes is not None:
+        workers["humming-query"] = run_clients(humming_clients, humming_query, stop)
+
+    time.sleep(duration)
+    stop.set()
+    for threads, _ in workers.values():
+        for thread in threads:
+            thread.join()
+    return {name: summarize(samples) for name, (_, samples) in workers.items()}
+
+# Main Execution
+if __name__ == "__main__":
+    # Usage: python loadtest.py <query image> [humming recording] [--url URL] [--duration SECONDS]
+    parser = argparse.ArgumentParser(description="Measure gallery and image-query latency while humming queries run.")
+    parser.add_argument("image")
+    parser.add_argument("humming", nargs="?")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--gallery-clients", type=int, default=8)
+    parser.add_argument("--image-clients", type=int, default=4)
+    parser.add_argument("--humming-clients", type=int, default=1)
+    args = parser.parse_args()
+
+    report = load_test(args.url.rstrip("/"), args.image, args.humming, args.duration,
+                       args.gallery_clients, args.image_clients, args.humming_clients)
+    json.dump(report, sys.stdout, indent=2)
+    print()
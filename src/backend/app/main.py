@@ -1,17 +1,13 @@
 import os
-import json
-import shutil
-import zipfile
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+import queue
+import asyncio
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
-from pathlib import Path
-import midi_processor,image_processor,mic_controller,audio_converter
-from basic_pitch.inference import predict
-from basic_pitch import ICASSP_2022_MODEL_PATH
-import time
+from typing import List, Optional
+import midi_processor,image_processor,mic_controller,audio_converter,dataset_store,ingestion,ann_index,ngram_index,transcriber,feature_cache,executors,dataset_registry,mapping_index,catalogue,metrics,scoring_pool,result_cache,melody_rerank
 import ffmpeg
-import imageio_ffmpeg
 
 app = FastAPI()
 
@@ -22,15 +18,28 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Total-Count", "X-Next-Cursor", "Link", "Server-Timing"],
 )
 
-mean_dataset = None
-projected_dataset = None
-eigenvectors = None
 newest_json_path = None
 current_dataset = None
 result = []
-preprocess_result = []
+transcription_service = None
+mounted_datasets = set()
+
+DATASETS_ROOT = "datasets"
+FEATURE_CACHE_DIRECTORY = os.path.join(DATASETS_ROOT, ".feature_cache")
+
+# Every dataset under DATASETS_ROOT can be queried by id; current_dataset is only the default
+registry = dataset_registry.DatasetRegistry(DATASETS_ROOT)
+
+# Requests each endpoint runs at once, and how many more may wait; anything beyond gets a 503
+limiters = {
+    "upload": executors.EndpointLimiter(max_concurrent=1, max_queued=2),
+    "midi-query": executors.EndpointLimiter(max_concurrent=4, max_queued=32),
+    "image-query": executors.EndpointLimiter(max_concurrent=4, max_queued=32),
+    "humming-query": executors.EndpointLimiter(max_concurrent=2, max_queued=8),
+}
 
 def unmount_static_path(path: str):
     """
@@ -39,6 +48,285 @@ def unmount_static_path(path: str):
     if path in app.routes:
         app.routes = [route for route in app.routes if route.path != path]
 
+def mount_dataset(dataset_path):
+    """
+    Helper function to serve the album and song folders of a dataset.
+    """
+    dataset_name = os.path.basename(dataset_path)
+    if dataset_name in mounted_datasets:
+        return
+    mounted_datasets.add(dataset_name)
+    app.mount(f"/datasets/{dataset_name}/album", StaticFiles(directory=os.path.join(dataset_path, "album")), name=f"{dataset_name}_album")
+    app.mount(f"/datasets/{dataset_name}/song", StaticFiles(directory=os.path.join(dataset_path, "song")), name=f"{dataset_name}_song")
+
+def reserve_slot(endpoint):
+    """
+    Helper function to take a place in an endpoint's queue, answering 503 when it is full.
+    """
+    try:
+        return limiters[endpoint].slot()
+    except queue.Full:
+        raise HTTPException(status_code=503, detail="Server is busy, try again later")
+
+def rank_songs(dataset, queries, query_notes, full_scan, sampling, max_windows, seed, top_k, rerank_top_n, rerank_budget):
+    """
+    Helper function to score a melody against a dataset and, if asked, re-rank the leading songs by DTW; blocking,
+    so it runs on the query executor.
+    Returns (ranking, whether it came from the result cache).
+    """
+    # The notes determine the features, so the same melody ranks the same whether it came from MIDI or humming
+    key = result_cache.result_key(dataset, "melody", result_cache.melody_fingerprint(query_notes),
+                                  (full_scan, sampling, max_windows, seed, top_k, rerank_top_n, rerank_budget))
+    ranking = result_cache.shared_cache.get(key)
+    if ranking is not None:
+        return ranking, True
+
+    melody_index = dataset["melody_index"]
+    # Re-ranking needs its leading songs from the first stage, ahead of the rest asked for
+    first_stage_k = top_k
+    if rerank_top_n > 0 and top_k is not None:
+        first_stage_k = max(top_k, rerank_top_n)
+    with metrics.stage("scoring"):
+        candidates = None if full_scan or melody_index is None else ngram_index.find_candidates(melody_index, query_notes)
+        sorted = midi_processor.compare(dataset["feature_index"], queries, candidates, sampling, max_windows, seed,
+                                        first_stage_k, scorer=scoring_pool.shared_pool.score)
+    if rerank_top_n > 0:
+        with metrics.stage("rerank"):
+            sorted, stats = melody_rerank.rerank_songs(dataset["feature_index"], sorted, query_notes, rerank_top_n,
+                                                       rerank_budget, top_k)
+        metrics.inc("rerank_songs_total", stats["songs"])
+        metrics.inc("rerank_stretches_total", stats["windows"])
+        metrics.inc("rerank_stretches_aligned_total", stats["aligned"])
+        metrics.inc("rerank_over_budget_total", int(stats["over_budget"]))
+    with metrics.stage("ranking"):
+        ranking = tuple(midi_processor.get_similarities(sorted[:top_k]))
+    result_cache.shared_cache.put(key, ranking)
+    return ranking, False
+
+def rank_midi_file(dataset, data, full_scan, sampling, max_windows, seed, top_k, rerank_top_n, rerank_budget):
+    # Keyed by content, so re-uploading a changed file under the same name is never served stale
+    atb, rtb, ftb, query_notes = midi_processor.get_cached_features(data)
+    return rank_songs(dataset, (atb, rtb, ftb), query_notes, full_scan, sampling, max_windows, seed, top_k,
+                      rerank_top_n, rerank_budget)
+
+def rank_note_events(dataset, note_events, full_scan, sampling, max_windows, seed, top_k, rerank_top_n, rerank_budget):
+    with metrics.stage("note_extraction"):
+        query_notes = audio_converter.note_events_to_notes(note_events)
+    with metrics.stage("feature_extraction"):
+        queries = midi_processor.get_feature(query_notes)
+    return rank_songs(dataset, queries, query_notes, full_scan, sampling, max_windows, seed, top_k, rerank_top_n,
+                      rerank_budget)
+
+def rank_image(dataset, image_path, top_k, threshold, nprobe):
+    """
+    Helper function to rank a dataset's covers by similarity to an image; returns ([(name, similarity)], cached).
+    """
+    image_model = dataset["image_model"]
+    if image_model is None:
+        # Fewer than two covers: there is no PCA model, and nothing to rank
+        return (), False
+    with metrics.stage("decode"):
+        processed_query = image_processor.process_query_image(image_path)
+    if processed_query is None:
+        raise ValueError(f"Could not decode {image_path}")
+
+    # Keyed by the decoded pixels, so a re-encoded copy of a cover hits too
+    key = result_cache.result_key(dataset, "image", result_cache.fingerprint(processed_query), (top_k, threshold, nprobe))
+    ranking = result_cache.shared_cache.get(key)
+    if ranking is not None:
+        return ranking, True
+
+    similarities, sorted_indices = image_processor.query_processed_image(
+        processed_query, image_model["eigenvectors"], image_model["projected_dataset"],
+        image_model["mean_dataset"], top_k=top_k, threshold=threshold, index=dataset["ivf_index"], nprobe=nprobe
+    )
+    ranking = tuple(image_processor.get_similarities(similarities, sorted_indices, threshold, image_model["image_names"]))
+    result_cache.shared_cache.put(key, ranking)
+    return ranking, False
+
+def build_song_results(mapping, dataset_id, sorted_midi, base_url):
+    """
+    Helper function to turn ranked (song, score) pairs into response entries with cover and song URLs.
+    """
+    result = []
+    with metrics.stage("response"):
+        for index, (song_name, similarity_score) in enumerate(sorted_midi):
+            title = os.path.basename(song_name)
+            cover, src = mapping.song_link(dataset_id, title)
+            result.append({
+                "id": index + 1,
+                "cover": f"{base_url}{cover}" if cover else None,
+                "title": title,
+                "src": f"{base_url}{src}",
+                "similarity_score": float(similarity_score),
+            })
+    return result
+
+def query_response(result, profile=False, cached=False):
+    """
+    Helper function to wrap query results with the request's total time and per-stage timings (in ms).
+    """
+    response = {"result": result, "time_taken": metrics.elapsed(), "stages": metrics.stage_timings(), "cached": cached}
+    if profile:
+        response["profile"] = metrics.stop_profiler()
+    return response
+
+def activate_dataset(dataset_path, stored):
+    """
+    Helper function to publish a freshly built dataset and make it the default one answering queries.
+    """
+    global current_dataset
+    dataset = registry.publish(os.path.basename(dataset_path), stored)
+    result_cache.shared_cache.invalidate(os.path.basename(dataset_path))
+    current_dataset = dataset_path
+    return dataset
+
+async def get_dataset(dataset_id):
+    """
+    Helper function to get a dataset snapshot, loading it off the event loop when it is not resident.
+    """
+    dataset = registry.get_resident(dataset_id)
+    if dataset is None:
+        dataset = await executors.run_in_executor(executors.file_executor, registry.get, dataset_id)
+    return dataset
+
+async def resolve_dataset(dataset_id=None):
+    """
+    Helper function to get the dataset a request names, or the current dataset when it names none.
+    """
+    if dataset_id is None:
+        if not current_dataset:
+            raise HTTPException(status_code=400, detail="No dataset loaded")
+        dataset_id = os.path.basename(current_dataset)
+    dataset = await get_dataset(dataset_id)
+    if dataset is None:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset: {dataset_id}")
+    mount_dataset(dataset["path"])
+    return dataset
+
+def collect_metrics():
+    """
+    Helper function to refresh the metrics other modules already keep: cache counters, dataset sizes and queues.
+    """
+    for name, value in feature_cache.shared_cache.stats().items():
+        if name != "disk_tier":
+            metrics.set_value(f"feature_cache_{name}", value)
+    loaded = registry.loaded_datasets()
+    metrics.set_value("datasets_loaded", len(loaded))
+    for name in ("dataset_songs", "dataset_windows", "dataset_images", "dataset_index_bytes"):
+        metrics.clear(name)
+    for dataset in loaded:
+        dataset_id = dataset["id"]
+        feature_index = dataset["feature_index"] or {}
+        image_model = dataset["image_model"] or {}
+        metrics.set_value("dataset_songs", len(feature_index.get("song_names", [])), dataset=dataset_id)
+        metrics.set_value("dataset_windows", len(feature_index.get("features", [])), dataset=dataset_id)
+        metrics.set_value("dataset_images", len(image_model.get("image_names", [])), dataset=dataset_id)
+        metrics.set_value("dataset_index_bytes", dataset["size_bytes"], dataset=dataset_id)
+    for name, value in result_cache.shared_cache.stats().items():
+        metrics.set_value(f"result_cache_{name}", value)
+    for endpoint, limiter in limiters.items():
+        stats = limiter.stats()
+        metrics.set_value("endpoint_running", stats["running"], endpoint=endpoint)
+        metrics.set_value("endpoint_queued", stats["queued"], endpoint=endpoint)
+
+metrics.add_collector(collect_metrics)
+for name in ("hits", "disk_hits", "misses", "evictions", "disk_evictions"):
+    metrics.describe(f"feature_cache_{name}", "counter", f"Feature cache {name.replace('_', ' ')}.")
+for name in ("hits", "misses", "expirations", "evictions"):
+    metrics.describe(f"result_cache_{name}", "counter", f"Query result cache {name}.")
+metrics.describe("rerank_songs_total", "counter", "Songs re-ranked by DTW.")
+metrics.describe("rerank_stretches_total", "counter", "Song stretches considered for DTW re-ranking.")
+metrics.describe("rerank_stretches_aligned_total", "counter", "Song stretches aligned by DTW; the rest were pruned by LB_Keogh or the budget.")
+metrics.describe("rerank_over_budget_total", "counter", "Queries whose re-ranking ran out of time budget.")
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """
+    Middleware timing every request and exposing its stage timings in a Server-Timing header.
+    """
+    trace = metrics.start_trace()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        timing = trace.server_timing()
+        if timing:
+            response.headers["Server-Timing"] = timing
+        return response
+    finally:
+        if trace.profiler is not None:
+            trace.profiler.stop()
+        # Label by route template rather than raw path, so per-file URLs don't explode the series
+        route = request.scope.get("route")
+        endpoint = getattr(route, "path", "unmatched")
+        metrics.observe("http_request_duration_seconds", trace.elapsed(), endpoint=endpoint)
+        metrics.inc("http_requests_total", endpoint=endpoint, method=request.method, status=status)
+
+
+@app.on_event("startup")
+def start_transcription_service():
+    """
+    Load the basic_pitch model once and keep it resident for humming queries.
+    """
+    global transcription_service
+    transcription_service = transcriber.TranscriptionService()
+
+@app.on_event("shutdown")
+def stop_executors():
+    """
+    Stop the worker pools so pending background work does not outlive the server.
+    """
+    executors.shutdown()
+    scoring_pool.shared_pool.shutdown()
+
+@app.on_event("startup")
+def start_scoring_pool():
+    """
+    Spawn the scoring workers in the background, so the first large query doesn't wait for them.
+    """
+    executors.query_executor.submit(scoring_pool.shared_pool.start)
+
+@app.on_event("startup")
+def enable_feature_cache():
+    """
+    Keep parsed MIDI features on disk so they survive restarts and are shared across datasets.
+    """
+    feature_cache.shared_cache.use_directory(FEATURE_CACHE_DIRECTORY)
+
+@app.on_event("startup")
+def restore_dataset():
+    """
+    Reload the last active dataset from its on-disk feature store.
+    """
+    global newest_json_path
+    current = dataset_store.load_current(DATASETS_ROOT)
+    if current is None:
+        return
+
+    stored = dataset_store.load_dataset(current["dataset_path"], current["content_hash"])
+    if stored is None:
+        print(f"No stored features found for {current['dataset_path']}, skipping restore.")
+        return
+
+    activate_dataset(current["dataset_path"], stored)
+    mount_dataset(current["dataset_path"])
+    if current.get("mapper_path") and os.path.exists(current["mapper_path"]):
+        newest_json_path = current["mapper_path"]
+        mapping_index.load_mapping(newest_json_path)
+    print(f"Restored dataset {current_dataset} from its feature store.")
+
+@app.get("/datasets/")
+async def list_datasets():
+    """
+    Endpoint listing every stored dataset that can be queried by id, and which ones are resident.
+    """
+    return {
+        "datasets": registry.list_datasets(),
+        "current_dataset": os.path.basename(current_dataset) if current_dataset else None,
+    }
+
 @app.post("/reset/")
 async def reset_dataset():
     """
@@ -48,16 +336,26 @@ async def reset_dataset():
     current_dataset = None
     global newest_json_path
     newest_json_path = None
+    dataset_store.clear_current(DATASETS_ROOT)
+    result_cache.shared_cache.invalidate()
     print("Current dataset has been reset.")
     return {"message": "Dataset reset successfully.", "current_dataset": current_dataset}
 
 
 
 @app.post("/upload/")
-async def upload_file(file: UploadFile = File(...)):
-    global current_dataset, newest_json_path,preprocess_result,eigenvectors,projected_dataset,mean_dataset
+async def upload_file(file: UploadFile = File(...), mode: str = "replace"):
+    """
+    Upload a single file, or a ZIP dataset. With mode="replace" the dataset ends up holding
+    exactly the ZIP's files; with mode="append" the ZIP's files are added to it.
+    Either way only new or changed files are reprocessed.
+    """
+    global newest_json_path
     file_type = file.content_type
 
+    if mode not in ("replace", "append"):
+        raise HTTPException(status_code=400, detail="Mode must be 'replace' or 'append'")
+
     if file_type not in [
         "image/png", 
         "image/jpeg", 
@@ -72,11 +370,15 @@ async def upload_file(file: UploadFile = File(...)):
         os.makedirs(directory, exist_ok=True)
 
         file_location = os.path.join(directory, file.filename)
-        with open(file_location, "wb") as buffer:
-            buffer.write(await file.read())
+        await executors.save_upload(file, file_location)
 
         if file_type == "application/json":
+            # Parse the mapper once now; queries reuse it until the file changes
+            await executors.run_in_executor(executors.file_executor, mapping_index.load_mapping, file_location)
             newest_json_path = file_location
+            dataset = await get_dataset(os.path.basename(current_dataset)) if current_dataset else None
+            if dataset is not None:
+                dataset_store.save_current(DATASETS_ROOT, current_dataset, dataset["content_hash"], newest_json_path)
             return {
                 "file_path": file_location, 
                 "message": "JSON file uploaded and set as the newest."
@@ -86,312 +388,251 @@ async def upload_file(file: UploadFile = File(...)):
 
     
     dataset_name = os.path.splitext(file.filename)[0]
-    dataset_path = os.path.join("datasets", dataset_name)
-
-    unmount_static_path(f"/datasets/{dataset_name}/album")
-    unmount_static_path(f"/datasets/{dataset_name}/song")
-
-    if os.path.exists(dataset_path):
-        shutil.rmtree(dataset_path)
-        
+    dataset_path = os.path.join(DATASETS_ROOT, dataset_name)
 
-    os.makedirs(dataset_path, exist_ok=True)
-    song_directory = os.path.join(dataset_path, "song")
-    album_directory = os.path.join(dataset_path, "album")
-    os.makedirs(song_directory, exist_ok=True)
-    os.makedirs(album_directory, exist_ok=True)
+    async with reserve_slot("upload"):
+        unmount_static_path(f"/datasets/{dataset_name}/album")
+        unmount_static_path(f"/datasets/{dataset_name}/song")
 
-    temp_directory = f"temp_{file.filename}_extracted"
-    os.makedirs(temp_directory, exist_ok=True)
+        os.makedirs(dataset_path, exist_ok=True)
 
-    try:
-        with zipfile.ZipFile(file.file, "r") as zip_ref:
-            zip_ref.extractall(temp_directory)
-
-        # Extracted files root
-        extracted_files = os.listdir(temp_directory)
-        root_extracted_path = (
-            os.path.join(temp_directory, extracted_files[0]) if len(extracted_files) == 1 else temp_directory
-        )
-
-        # Move files to respective directories
-        for filename in os.listdir(root_extracted_path):
-            file_path = os.path.join(root_extracted_path, filename)
-            if filename.endswith((".jpg", ".jpeg", ".png")):
-                shutil.move(file_path, album_directory)
-            elif filename.endswith((".midi", ".mid")):
-                shutil.move(file_path, song_directory)
-
-    except Exception as e:
-        shutil.rmtree(temp_directory)
-        raise HTTPException(status_code=500, detail=f"Error extracting ZIP file: {str(e)}")
-
-    shutil.rmtree(temp_directory)
-
-    current_dataset = dataset_path
-    preprocess_result = midi_processor.process_all_midi_files_concurrently(song_directory)
-    eigenvectors,projected_dataset,mean_dataset = image_processor.initialize_dataset_concurrently(current_dataset)
-
-    app.mount(f"/datasets/{dataset_name}/album", StaticFiles(directory=album_directory), name=f"{dataset_name}_album")
-    app.mount(f"/datasets/{dataset_name}/song", StaticFiles(directory=song_directory), name=f"{dataset_name}_song")
+        # Ingestion decodes in its own process pool; the ingest thread only keeps it off the event loop
+        try:
+            with metrics.stage("ingest"):
+                previous = await executors.run_in_executor(executors.ingest_executor, dataset_store.load_latest, dataset_path)
+                stored = await executors.run_in_executor(
+                    executors.ingest_executor, ingestion.ingest_zip,
+                    file.file, dataset_path, previous, append=(mode == "append")
+                )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error extracting ZIP file: {str(e)}")
+
+    dataset = activate_dataset(dataset_path, stored)
+    dataset_store.save_current(DATASETS_ROOT, dataset_path, stored["content_hash"], newest_json_path)
+    mount_dataset(dataset_path)
+    # Build the gallery catalogue now rather than on the first browse
+    await executors.run_in_executor(
+        executors.query_executor, catalogue.get_catalogue, dataset, mapping_index.load_mapping(newest_json_path)
+    )
 
     return {
-        "message": f"ZIP file extracted and files sorted into '{dataset_name}' dataset.",
+        "message": f"ZIP file streamed and files sorted into '{dataset_name}' dataset.",
         "current_dataset": current_dataset
     }
 
 
 
-@app.get("/gallery/")
-async def get_gallery(request: Request, search: str = ""):
-    global current_dataset
-
-    if not current_dataset or not os.path.exists(current_dataset):
-        return []
+@app.delete("/dataset/files/")
+async def delete_dataset_files(files: List[str] = Query(...), dataset: Optional[str] = None):
+    """
+    Endpoint to remove songs or album images from a dataset (the current one by default) without a full rebuild.
+    """
+    dataset_path = (await resolve_dataset(dataset))["path"]
+
+    async with reserve_slot("upload"):
+        removed = []
+        for filename in files:
+            for subdirectory in ("song", "album"):
+                file_path = os.path.join(dataset_path, subdirectory, os.path.basename(filename))
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+                    removed.append(f"{subdirectory}/{os.path.basename(filename)}")
+
+        previous = await executors.run_in_executor(executors.ingest_executor, dataset_store.load_latest, dataset_path)
+        stored = await executors.run_in_executor(executors.ingest_executor, ingestion.ingest_dataset, dataset_path, previous)
+    registry.publish(os.path.basename(dataset_path), stored)
+    result_cache.shared_cache.invalidate(os.path.basename(dataset_path))
+    if dataset_path == current_dataset:
+        dataset_store.save_current(DATASETS_ROOT, current_dataset, stored["content_hash"], newest_json_path)
+    return {"message": f"Removed {len(removed)} files.", "removed": removed, "current_dataset": current_dataset}
 
-    album_dir = Path(os.path.join(current_dataset, "album"))
-    song_dir = Path(os.path.join(current_dataset, "song"))
 
-    if not album_dir.exists() or not song_dir.exists():
+@app.get("/gallery/")
+async def get_gallery(request: Request, search: str = "", dataset: Optional[str] = None,
+                      limit: Optional[int] = None, offset: int = 0, cursor: Optional[str] = None):
+    """
+    Endpoint listing a dataset's songs and unmapped covers, optionally filtered by a substring.
+    The body stays a plain list; with `limit` set, the next page's cursor comes back in the
+    X-Next-Cursor and Link headers and the match count in X-Total-Count.
+    """
+    if dataset is None and not current_dataset:
         return []
+    dataset = await resolve_dataset(dataset)
+    catalogue_index = await executors.run_in_executor(
+        executors.query_executor, catalogue.get_catalogue, dataset, mapping_index.load_mapping(newest_json_path)
+    )
 
     base_url = str(request.base_url)
+    etag = catalogue_index.etag(base_url, search, limit, offset, cursor)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
 
-    audio_to_pic = {}
-    if newest_json_path:
-        try:
-            with open(newest_json_path, "r") as f:
-                json_data = json.load(f)
-                audio_to_pic = {entry["audio_file"]: entry["pic_name"] for entry in json_data}
-        except Exception:
-            pass
-
-    gallery_images = [file.name for file in album_dir.glob("*.jpg") if file.is_file()]
-    gallery_images += [file.name for file in album_dir.glob("*.jpeg") if file.is_file()]
-    gallery_images += [file.name for file in album_dir.glob("*.png") if file.is_file()]
-
-    gallery_files = [file.name for file in song_dir.glob("*.mid") if file.is_file()]
-
-    mapped_images = set(audio_to_pic.values())  
-    unmapped_images = [img for img in gallery_images if img not in mapped_images]
-
-    if search.strip():
-        gallery_files = [file for file in gallery_files if search.lower() in file.lower()]
-        unmapped_images = [img for img in unmapped_images if search.lower() in img.lower()]
+    positions = catalogue_index.search(search)
+    try:
+        page, next_cursor = catalogue_index.page(positions, limit, max(0, offset), cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     result = []
+    for position in page:
+        item = catalogue_index.items[position]
+        result.append({
+            "id": item["id"],
+            "cover": f"{base_url}{item['cover']}" if item["cover"] else None,
+            "title": item["title"],
+            "src": f"{base_url}{item['src']}" if item["src"] else None,
+        })
 
-    result += [
-        {
-            "id": index + 1,
-            "cover": f"{base_url}datasets/{os.path.basename(current_dataset)}/album/{audio_to_pic.get(midi_file, '').split('.')[0]}.jpg"
-            if audio_to_pic.get(midi_file)
-            else None,
-            "title": midi_file,
-            "src": f"{base_url}datasets/{os.path.basename(current_dataset)}/song/{midi_file}",
-        }
-        for index, midi_file in enumerate(gallery_files)
-    ]
-
-    result += [
-        {
-            "id": len(result) + index + 1,
-            "cover": f"{base_url}datasets/{os.path.basename(current_dataset)}/album/{img}",
-            "title": img,
-            "src": None,  
-        }
-        for index, img in enumerate(unmapped_images)
-    ]
-
-    return result
+    headers = {"ETag": etag, "X-Total-Count": str(len(positions))}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+        next_url = request.url.include_query_params(cursor=next_cursor).remove_query_params("offset")
+        headers["Link"] = f'<{next_url}>; rel="next"'
+    return JSONResponse(result, headers=headers)
 
 
 
 @app.post("/midi-query/")
-async def midi_query(request: Request,file: UploadFile = File(...)):
-    global current_dataset
+async def midi_query(request: Request,file: UploadFile = File(...), full_scan: bool = False,
+                     sampling: str = "all", max_windows: int = Query(midi_processor.MAX_QUERY_WINDOWS, ge=1), seed: int = 0,
+                     top_k: Optional[int] = Query(None, ge=1), dataset: Optional[str] = None, profile: bool = False,
+                     rerank_top_n: int = melody_rerank.RERANK_TOP_N, rerank_budget: float = melody_rerank.RERANK_TIME_BUDGET):
+    if sampling not in midi_processor.QUERY_SAMPLING_MODES:
+        raise HTTPException(status_code=400, detail=f"sampling must be one of {', '.join(midi_processor.QUERY_SAMPLING_MODES)}")
+    if rerank_top_n < 0 or rerank_budget < 0:
+        raise HTTPException(status_code=400, detail="rerank_top_n and rerank_budget must not be negative")
     if not file.filename.endswith((".mid", ".midi")):
         raise HTTPException(status_code=400, detail="File must be a MIDI file")
-    
+    # Queries keep this snapshot even if the dataset is rebuilt and swapped meanwhile
+    dataset = await resolve_dataset(dataset)
     
     base_url = str(request.base_url)
 
-    upload_file_path = f"uploads/song/{file.filename}"
-    with open(upload_file_path, "wb") as f:
-        f.write(await file.read())
-
-    try:
-        timenow = time.time()
-        query_notes = midi_processor.get_midi_notes(upload_file_path)
-        queries = midi_processor.get_feature(query_notes)
-        sorted = midi_processor.compare(preprocess_result, queries)
-        sorted_midi = midi_processor.get_similarities(sorted)
-        timeend = time.time()
-        
-    except:
-        raise HTTPException(status_code=500, detail="Error processing MIDI file")
-
-    audio_to_pic = {}
-    if newest_json_path:
+    if profile:
+        metrics.start_profiler()
+    async with reserve_slot("midi-query"):
+        # Read only once admitted, so rejected requests cost no buffering; ranked straight from memory, never written to disk
+        data = await file.read()
         try:
-            with open(newest_json_path, "r") as f:
-                json_data = json.load(f)
-                audio_to_pic = {entry["audio_file"]: entry["pic_name"] for entry in json_data}
-        except Exception:
-            pass
-    
-    time_taken = timeend - timenow
-
-    result = [
-        {
-            "id": index + 1,
-            "cover": f"{base_url}datasets/{os.path.basename(current_dataset)}/album/{audio_to_pic.get(os.path.basename(midi_file[0]), '').split('.')[0]}.jpg"
-            if audio_to_pic.get(os.path.basename(midi_file[0]))
-            else None,
-            "title": os.path.basename(midi_file[0]),
-            "src": f"{base_url}datasets/{os.path.basename(current_dataset)}/song/{os.path.basename(midi_file[0])}",
-            "similarity_score": float(midi_file[1]), 
-        }
-        for index, midi_file in enumerate(sorted_midi)
-    ]
-    return {"result": result, "time_taken": time_taken}
+            sorted_midi, cached = await executors.run_in_executor(
+                executors.query_executor, rank_midi_file, dataset, data, full_scan, sampling, max_windows, seed, top_k,
+                rerank_top_n, rerank_budget
+            )
+        except:
+            raise HTTPException(status_code=500, detail="Error processing MIDI file")
 
+    result = build_song_results(mapping_index.load_mapping(newest_json_path), dataset["id"], sorted_midi, base_url)
+    return query_response(result, profile, cached)
 
-@app.post("/image-query/")
-async def image_query(request: Request, file: UploadFile = File(...)):
-    global current_dataset
 
+@app.get("/feature-cache/")
+async def feature_cache_stats():
+    """
+    Endpoint reporting the MIDI feature cache's size and hit/miss counters.
+    """
+    return feature_cache.shared_cache.stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Endpoint exposing request latencies, stage timings, cache counters and dataset sizes for Prometheus.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/image-query/")
+async def image_query(request: Request, file: UploadFile = File(...), top_k: Optional[int] = Query(None, ge=1),
+                      threshold: float = 0.7, nprobe: int = Query(ann_index.DEFAULT_NPROBE, ge=1),
+                      dataset: Optional[str] = None, profile: bool = False):
     if not file.filename.lower().endswith((".jpg", ".jpeg", ".png")):
         raise HTTPException(status_code=400, detail="File must be an image file")
+    dataset = await resolve_dataset(dataset)
     
-    # Load the picture-to-audio mapping
-    pic_to_audio = {}
-    if newest_json_path:
-        try:
-            with open(newest_json_path, "r") as f:
-                json_data = json.load(f)
-                # Ensure these match your JSON structure exactly.
-                # For example, if JSON entries look like:
-                # { "pic_name": "cover.jpg", "audio_file": "track.mid" }
-                pic_to_audio = {entry["pic_name"]: entry["audio_file"] for entry in json_data}
-        except Exception:
-            pass
+    # Picture-to-audio links, parsed once per mapper file version
+    image_links = mapping_index.load_mapping(newest_json_path).get_image_links(dataset["id"])
     
     base_url = str(request.base_url)
+    if profile:
+        metrics.start_profiler()
     upload_file_path = f"uploads/album/{file.filename}"
 
-    with open(upload_file_path, "wb") as f:
-        f.write(await file.read())
-
-    try:
-        # Perform the image query
-        timenow = time.time()
-        similarities, sorted_indices = image_processor.query_image(
-            upload_file_path, eigenvectors, projected_dataset, mean_dataset
-        )
-        result = image_processor.get_similarities(similarities, sorted_indices)
-        timeend = time.time()
-    except Exception as e:
-        print(f"Error: {e}")
-        raise HTTPException(status_code=500, detail="Error processing image file")
-    
-    time_taken = timeend - timenow
+    async with reserve_slot("image-query"):
+        # Saved only once admitted, so rejected requests cost no disk write
+        await executors.save_upload(file, upload_file_path)
+        try:
+            # Perform the image query
+            result, cached = await executors.run_in_executor(
+                executors.query_executor, rank_image, dataset, upload_file_path, top_k, threshold, nprobe
+            )
+        except Exception as e:
+            print(f"Error: {e}")
+            raise HTTPException(status_code=500, detail="Error processing image file")
 
     # Filter the results to only include those images for which we have a .mid file
     midi_result = []
-    for index, (img, similarity) in enumerate(result):
-        # Check if we have a corresponding MIDI file for this image
-        midi_file_name = pic_to_audio.get(img, '')
-        if midi_file_name.endswith(".mid"):
-            midi_file_url = f"{base_url}datasets/{os.path.basename(current_dataset)}/song/{midi_file_name}"
-            cover_url = f"{base_url}datasets/{os.path.basename(current_dataset)}/album/{img}"
-            midi_result.append({
-                "id": index + 1,
-                "src": midi_file_url,
-                "title": midi_file_name,
-                "cover": cover_url,
-                "similarity_score": float(similarity)
-            })
-
-    return {"result": midi_result, "time_taken": time_taken}
+    with metrics.stage("response"):
+        for index, (img, similarity) in enumerate(result):
+            # Check if we have a corresponding MIDI file for this image
+            links = image_links.get(img)
+            if links is not None:
+                midi_file_name, src, cover = links
+                midi_result.append({
+                    "id": index + 1,
+                    "src": f"{base_url}{src}",
+                    "title": midi_file_name,
+                    "cover": f"{base_url}{cover}",
+                    "similarity_score": float(similarity)
+                })
+
+    return query_response(midi_result, profile, cached)
 
 
 @app.post("/humming-query/")
-async def humming_query(request = Request,file: UploadFile = File(...)):
-    if not os.path.exists("uploads/humming"):
-        os.makedirs("uploads/humming")
-    
-    if os.path.exists(f"uploads/humming/{file.filename}"):
-        os.remove(f"uploads/humming/{file.filename}")
-
-    recording_path = f"uploads/humming/{file.filename}"
-    with open(recording_path, "wb") as f:
-        f.write(await file.read())
-
-    if os.path.exists("uploads/humming/humming_output.mid"):
-        os.remove("uploads/humming/humming_output.mid")
-    
-    if os.path.exists("uploads/humming/humming_output.wav"):
-        os.remove("uploads/humming/humming_output.wav")
-
-    recording_output_ffmpeg = "uploads/humming/humming_output.wav"
-    ffmpeg_binary = imageio_ffmpeg.get_ffmpeg_exe()
-    
-    ffmpeg.input(recording_path).output(
-        recording_output_ffmpeg,
-        format='wav',
-        ar=44100,
-        ac=1
-    ).run(cmd=ffmpeg_binary, overwrite_output=True)
-    
-    model_output, midi_data, note_events = predict(
-        recording_output_ffmpeg,
-        model_or_model_path=ICASSP_2022_MODEL_PATH,
-        onset_threshold=0.6,
-        frame_threshold=0.3,
-        minimum_note_length=0.5
-    )
-
-    filtered_events = [note for note in note_events if note[3] > 0.25]
-
-    humming_output_path = "uploads/humming/humming_output.mid"
-    audio_converter.save_note_events_to_midi(filtered_events, humming_output_path)
+async def humming_query(request = Request,file: UploadFile = File(...), full_scan: bool = False,
+                        sampling: str = "all", max_windows: int = Query(midi_processor.MAX_QUERY_WINDOWS, ge=1), seed: int = 0,
+                        top_k: Optional[int] = Query(None, ge=1), dataset: Optional[str] = None, profile: bool = False,
+                        rerank_top_n: int = melody_rerank.RERANK_TOP_N, rerank_budget: float = melody_rerank.RERANK_TIME_BUDGET):
+    if sampling not in midi_processor.QUERY_SAMPLING_MODES:
+        raise HTTPException(status_code=400, detail=f"sampling must be one of {', '.join(midi_processor.QUERY_SAMPLING_MODES)}")
+    if rerank_top_n < 0 or rerank_budget < 0:
+        raise HTTPException(status_code=400, detail="rerank_top_n and rerank_budget must not be negative")
+    dataset = await resolve_dataset(dataset)
+    if profile:
+        metrics.start_profiler()
+    async with reserve_slot("humming-query"):
+        # Read only once admitted; decoded over ffmpeg pipes straight into memory, with no temporary WAV or MIDI files
+        recording = await file.read()
+        try:
+            with metrics.stage("decode"):
+                audio = await executors.run_in_executor(
+                    executors.query_executor, audio_converter.decode_audio, recording, transcriber.AUDIO_SAMPLE_RATE
+                )
+        except ffmpeg.Error:
+            raise HTTPException(status_code=400, detail="Could not decode humming recording")
+
+        # Transcription runs on the resident model's worker, so the event loop stays free
+        with metrics.stage("transcription"):
+            try:
+                transcription = transcription_service.submit(audio)
+            except queue.Full:
+                raise HTTPException(status_code=503, detail="Transcription service is busy, try again later")
+            note_events = await asyncio.wrap_future(transcription)
+
+        filtered_events = [note for note in note_events if note[3] > 0.25]
 
-    try:
-        timenow = time.time()
-        query_notes = midi_processor.get_midi_notes(humming_output_path)
-        queries = midi_processor.get_feature(query_notes)
-        sorted = midi_processor.compare(preprocess_result, queries)
-        sorted_midi = midi_processor.get_similarities(sorted)
-        timeend = time.time()
-    except:
-        raise HTTPException(status_code=500, detail="Error processing humming file")
-
-    audio_to_pic = {}
-    if newest_json_path:
         try:
-            with open(newest_json_path, "r") as f:
-                json_data = json.load(f)
-                audio_to_pic = {entry["audio_file"]: entry["pic_name"] for entry in json_data}
-        except Exception:
-            pass
-    
-    time_taken = timeend - timenow
+            sorted_midi, cached = await executors.run_in_executor(
+                executors.query_executor, rank_note_events, dataset, filtered_events, full_scan, sampling, max_windows, seed, top_k,
+                rerank_top_n, rerank_budget
+            )
+        except:
+            raise HTTPException(status_code=500, detail="Error processing humming file")
+
     base_url = str(request.base_url)    
     print(base_url)
-    result = [
-        {
-            "id": index + 1,
-            "cover": f"http://127.0.0.1:8000/datasets/{os.path.basename(current_dataset)}/album/{audio_to_pic.get(os.path.basename(midi_file[0]), '').split('.')[0]}.jpg"
-            if audio_to_pic.get(os.path.basename(midi_file[0]))
-            else None,
-            "title": os.path.basename(midi_file[0]),
-            "src": f"http://127.0.0.1:8000/datasets/{os.path.basename(current_dataset)}/song/{os.path.basename(midi_file[0])}",
-            "similarity_score": float(midi_file[1]), 
-        }
-        for index, midi_file in enumerate(sorted_midi)
-    ]
+    result = build_song_results(mapping_index.load_mapping(newest_json_path), dataset["id"], sorted_midi, "http://127.0.0.1:8000/")
 
     print(result)
 
-    return {"result": result, "time_taken": time_taken}
+    return query_response(result, profile, cached)
@@ -0,0 +1,84 @@
+import os
+import json
+import threading
+
+class MappingIndex:
+    """Song/cover mapping parsed from a mapper JSON file, with URL paths cached per dataset.
+
+    The mapper is a list of {"audio_file": ..., "pic_name": ...} entries. URL
+    paths are relative to the server root, so responses only prepend their base URL.
+    """
+
+    def __init__(self, entries=()):
+        self.audio_to_pic = {}
+        self.pic_to_audio = {}
+        for entry in entries:
+            self.audio_to_pic[entry["audio_file"]] = entry["pic_name"]
+            self.pic_to_audio[entry["pic_name"]] = entry["audio_file"]
+        self.mapped_images = set(self.audio_to_pic.values())
+        self.song_links = {}
+        self.image_links = {}
+        self.lock = threading.Lock()
+
+    def get_song_links(self, dataset_id):
+        """{audio file: (cover path or None, song path)} for every mapped song."""
+        with self.lock:
+            links = self.song_links.get(dataset_id)
+            if links is None:
+                links = {
+                    audio_file: (f"datasets/{dataset_id}/album/{pic_name.split('.')[0]}.jpg" if pic_name else None,
+                                 f"datasets/{dataset_id}/song/{audio_file}")
+                    for audio_file, pic_name in self.audio_to_pic.items()
+                }
+                self.song_links[dataset_id] = links
+            return links
+
+    def get_image_links(self, dataset_id):
+        """{cover name: (audio file, song path, cover path)} for covers mapped to a MIDI file."""
+        with self.lock:
+            links = self.image_links.get(dataset_id)
+            if links is None:
+                links = {
+                    pic_name: (audio_file, f"datasets/{dataset_id}/song/{audio_file}", f"datasets/{dataset_id}/album/{pic_name}")
+                    for pic_name, audio_file in self.pic_to_audio.items()
+                    if audio_file.endswith(".mid")
+                }
+                self.image_links[dataset_id] = links
+            return links
+
+    def song_link(self, dataset_id, audio_file):
+        """(cover path or None, song path) of any song, mapped or not."""
+        links = self.get_song_links(dataset_id).get(audio_file)
+        return links if links is not None else (None, f"datasets/{dataset_id}/song/{audio_file}")
+
+EMPTY_MAPPING = MappingIndex()
+
+cached_mappings = {}  # path -> (mtime_ns, size, MappingIndex)
+cache_lock = threading.Lock()
+
+def load_mapping(path):
+    """MappingIndex of a mapper file, re-parsed only when its mtime or size changes.
+
+    Returns an empty mapping when there is no mapper file or it cannot be parsed.
+    """
+    if not path:
+        return EMPTY_MAPPING
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return EMPTY_MAPPING
+
+    with cache_lock:
+        cached = cached_mappings.get(path)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+
+    try:
+        with open(path, "r") as f:
+            mapping = MappingIndex(json.load(f))
+    except Exception as e:
+        print(f"Error reading mapper file {path}: {e}")
+        mapping = EMPTY_MAPPING
+    with cache_lock:
+        cached_mappings[path] = (stat.st_mtime_ns, stat.st_size, mapping)
+    return mapping
@@ -0,0 +1,191 @@
+import time
+import numpy as np
+import midi_processor
+
+RERANK_TOP_N = 0  # Leading songs of the first-stage ranking re-ordered by DTW; off unless a query asks for it
+RERANK_TIME_BUDGET = 0.05  # Seconds a query may spend re-ranking; songs not reached keep their first-stage order
+MAX_QUERY_INTERVALS = 64  # Query intervals aligned; longer queries are cut to their opening phrase
+MIN_QUERY_INTERVALS = 4  # Shorter queries (after dropping repeated notes) are not re-ranked
+BAND_FRACTION = 0.1  # Sakoe-Chiba band half-width, as a fraction of the aligned length
+MIN_BAND = 2
+FIRST_PASS_WINDOWS = 4  # Most promising stretches of every song aligned up front, to seed the pruning bounds
+WINDOW_CHUNK_SIZE = 1024  # Song stretches aligned per vectorized DTW pass; the budget is checked before each pass
+ABANDON_CHECK_STEPS = 8  # Anti-diagonals between early-abandoning checks
+
+def interval_sequence(notes):
+    """Key- and tempo-robust form of a melody: its pitch intervals, with repeated notes dropped and
+    intervals wider than an octave folded into one (a hummed jump is often an octave off)."""
+    intervals = np.diff(np.asarray(notes, dtype=np.int64))
+    intervals = intervals[intervals != 0]
+    return np.sign(intervals) * ((np.abs(intervals) - 1) % 12 + 1)
+
+def query_envelope(query, band):
+    """Upper and lower LB_Keogh envelopes of a query over a band of +-`band` positions."""
+    padded = np.pad(query, band, mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * band + 1)
+    return windows.max(axis=1), windows.min(axis=1)
+
+def lb_keogh(windows, upper, lower):
+    """LB_Keogh lower bound of the banded DTW distance between the query and every row of `windows`."""
+    return (np.maximum(windows - upper, 0) + np.maximum(lower - windows, 0)).sum(axis=1)
+
+def song_stretches(song_intervals, length, band):
+    """Stretches of `length` intervals starting every `band` intervals (the band absorbs smaller shifts), plus the last one."""
+    starts = np.arange(0, len(song_intervals) - length + 1, band)
+    if starts[-1] != len(song_intervals) - length:
+        starts = np.append(starts, len(song_intervals) - length)
+    return np.lib.stride_tricks.sliding_window_view(song_intervals, length)[starts]
+
+def banded_dtw(query, windows, band, bounds=np.inf):
+    """Banded DTW distances (absolute interval difference per step) between the query and every row of `windows`.
+
+    The cells are swept one anti-diagonal at a time, each step being a single vectorized update
+    over all windows. A window whose partial alignments all cost its bound or more is abandoned
+    early and reported as inf.
+    """
+    n_windows, length = windows.shape
+    bounds = np.broadcast_to(np.asarray(bounds, dtype=np.float32), n_windows)
+    # Query position, window position and out-of-matrix mask of every band slot on every anti-diagonal
+    steps = np.arange(2 * length - 1)[:, None] + np.arange(-band, band + 1)
+    rows = steps // 2
+    cols = np.arange(2 * length - 1)[:, None] - rows
+    outside = np.where((steps % 2 == 0) & (rows >= 0) & (rows < length) & (cols >= 0) & (cols < length), 0, np.inf)
+    query_values = query[np.clip(rows, 0, length - 1)][:, :, None].astype(np.float32)
+    cols = np.clip(cols, 0, length - 1)
+    outside = outside[:, :, None].astype(np.float32)
+
+    columns = np.ascontiguousarray(windows.T, dtype=np.float32)  # One row per position, gathered a slot at a time
+    distances = np.full(n_windows, np.inf)
+    alive = np.arange(n_windows)
+    # Anti-diagonals k - 2, k - 1 and k, each with an inf slot either side for the shifted neighbours
+    before, previous, current = (np.full((2 * band + 3, n_windows), np.inf, dtype=np.float32) for _ in range(3))
+
+    for k in range(2 * length - 1):
+        cost = np.abs(columns[cols[k]] - query_values[k])
+        cost += outside[k]
+        if k > 0:
+            # Cell (i, j) extends (i - 1, j) or (i, j - 1) on the previous anti-diagonal, or (i - 1, j - 1) before it
+            neighbours = np.minimum(previous[:-2], previous[2:])
+            np.minimum(neighbours, before[1:-1], out=neighbours)
+            cost += neighbours
+        current[1:-1] = cost
+        before, previous, current = previous, current, before
+
+        if k % ABANDON_CHECK_STEPS == ABANDON_CHECK_STEPS - 1:
+            # Every remaining path crosses anti-diagonal k or k + 1, so the cheaper of the last two bounds it
+            keep = np.minimum(previous.min(axis=0), before.min(axis=0)) < bounds
+            if not keep.all():
+                alive, bounds, columns = alive[keep], bounds[keep], columns[:, keep]
+                before, previous, current = before[:, keep], previous[:, keep], current[:, keep]
+                if len(alive) == 0:
+                    return distances
+
+    # The band is symmetric, so (length - 1, length - 1) sits in its middle slot
+    distances[alive] = previous[band + 1]
+    return distances
+
+def rerank_songs(feature_index, sorted_results, query_notes, top_n=RERANK_TOP_N, time_budget=RERANK_TIME_BUDGET, top_k=None):
+    """Re-order the leading `top_n` songs of a first-stage ranking by banded DTW over interval sequences.
+
+    Each song is ranked by the mean interval difference of its best-aligned stretch. Stretches are
+    aligned in LB_Keogh order across all songs at once, skipping those whose bound cannot beat their
+    song's best so far (nor, with `top_k`, the k-th best song). Once `time_budget` runs out the
+    remaining stretches are skipped too, so a song may then be ranked by its most promising stretches
+    only, and songs not aligned at all follow the others in their first-stage order.
+
+    Every song keeps its first-stage similarity_score, so scores stay on one scale whichever songs
+    were re-ranked; songs past `top_n` follow the re-ranked ones unchanged. Returns (ranking, stats).
+    """
+    stats = {"songs": 0, "windows": 0, "aligned": 0, "over_budget": False}
+    query = interval_sequence(query_notes)[:MAX_QUERY_INTERVALS].astype(np.float32)
+    if top_n <= 0:
+        return sorted_results, stats
+    if len(query) < MIN_QUERY_INTERVALS or len(sorted_results) == 0:
+        # Too short to align reliably; the first-stage order stands
+        return sorted_results, stats
+
+    deadline = time.perf_counter() + time_budget
+    # Keyed by names as compare stores them, cut to its 100 characters
+    song_ids = {name[:100]: song_id for song_id, name in enumerate(feature_index["song_names"])}
+    head = sorted_results[:top_n]
+    best = np.full(len(head), np.inf)  # Mean aligned difference of each song's best stretch so far
+
+    # Songs shorter than the query are aligned on their full length, so stretches are grouped by length
+    groups = {}
+    for position, song_name in enumerate(head["song_name"]):
+        song_intervals = interval_sequence(midi_processor.get_song_notes(feature_index, song_ids[song_name]))
+        length = min(len(query), len(song_intervals))
+        if length >= MIN_QUERY_INTERVALS:
+            band = max(MIN_BAND, int(length * BAND_FRACTION))
+            group = groups.setdefault(length, {"band": band, "windows": [], "owners": []})
+            group["windows"].append(song_stretches(song_intervals.astype(np.float32), length, band))
+            group["owners"].append(np.full(len(group["windows"][-1]), position))
+
+    for length, group in groups.items():
+        windows, owners = np.concatenate(group["windows"]), np.concatenate(group["owners"])
+        upper, lower = query_envelope(query[:length], group["band"])
+        # Lower bounds per aligned step, comparable across groups
+        lower_bounds = lb_keogh(windows, upper, lower) / length
+        # Rank of every stretch within its song, by bound
+        order = np.lexsort((lower_bounds, owners))
+        song_starts = np.flatnonzero(np.r_[True, owners[order][1:] != owners[order][:-1]])
+        ranks = np.arange(len(order)) - np.repeat(song_starts, np.diff(np.r_[song_starts, len(order)]))
+        # Seed stretches, every song's best one first, so a short budget still reaches every song it can
+        first, first_ranks = order[ranks < FIRST_PASS_WINDOWS], ranks[ranks < FIRST_PASS_WINDOWS]
+        group.update(windows=windows, owners=owners, lower_bounds=lower_bounds,
+                     pending=np.ones(len(windows), dtype=bool),
+                     first=first[np.lexsort((lower_bounds[first], first_ranks))])
+        stats["windows"] += len(windows)
+
+    def align(group, rows):
+        length = group["windows"].shape[1]
+        bounds = np.minimum(best[group["owners"][rows]], cutoff()) * length
+        distances = banded_dtw(query[:length], group["windows"][rows], group["band"], bounds) / length
+        np.minimum.at(best, group["owners"][rows], distances)
+        group["pending"][rows] = False
+        stats["aligned"] += len(rows)
+
+    def cutoff():
+        # A song can only enter the top k by beating the k-th best score found so far
+        if top_k is None or top_k >= len(best):
+            return np.inf
+        return np.partition(best, top_k - 1)[top_k - 1]
+
+    checked, pass_seconds = time.perf_counter(), 0.0
+
+    def out_of_time():
+        nonlocal checked, pass_seconds
+        now = time.perf_counter()
+        pass_seconds, checked = now - checked, now
+        # Passes take about as long as the one before, so one that would end past the deadline is not started
+        if now + pass_seconds <= deadline:
+            return False
+        stats["over_budget"] = any(group["pending"].any() for group in groups.values())
+        return True
+
+    # Seed every song's bound with its most promising stretches, then work through the rest in bound order
+    for group in groups.values():
+        for start in range(0, len(group["first"]), WINDOW_CHUNK_SIZE):
+            if out_of_time():
+                break
+            align(group, group["first"][start:start + WINDOW_CHUNK_SIZE])
+    while not out_of_time():
+        candidates = []
+        for group in groups.values():
+            rows = np.flatnonzero(group["pending"])
+            live = group["lower_bounds"][rows] < np.minimum(best[group["owners"][rows]], cutoff())
+            group["pending"][rows[~live]] = False
+            candidates.append(rows[live])
+        if not any(len(rows) for rows in candidates):
+            break
+        for group, rows in zip(groups.values(), candidates):
+            if len(rows) > WINDOW_CHUNK_SIZE:
+                # A pass aligns its rows together, so only which rows go in it matters, not their order
+                rows = rows[np.argpartition(group["lower_bounds"][rows], WINDOW_CHUNK_SIZE - 1)[:WINDOW_CHUNK_SIZE]]
+            if len(rows):
+                align(group, rows)
+    stats["songs"] = len(head)
+
+    # Songs never aligned keep inf, and so their first-stage order, after the aligned ones
+    order = np.argsort(best, kind="stable")
+    return np.concatenate((head[order], sorted_results[top_n:])), stats
@@ -0,0 +1,242 @@
+import os
+import sys
+import time
+import threading
+import contextlib
+import contextvars
+from collections import Counter
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # Seconds
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples
+PROFILE_MAX_DEPTH = 48
+PROFILE_TOP_STACKS = 25
+
+lock = threading.Lock()
+metric_types = {}  # name -> (type, help)
+values = {}  # (name, labels) -> value, for counters and gauges
+histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+collectors = []
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def describe(name, metric_type, help_text):
+    metric_types[name] = (metric_type, help_text)
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name, value=1, **labels):
+    key = (name, label_key(labels))
+    with lock:
+        values[key] = values.get(key, 0) + value
+
+def set_value(name, value, **labels):
+    """Set a gauge, or a counter mirrored from somewhere that already counts it."""
+    with lock:
+        values[(name, label_key(labels))] = value
+
+def clear(name):
+    """Drop every labelled value of a gauge, e.g. before re-collecting series that may have disappeared."""
+    with lock:
+        for key in [key for key in values if key[0] == name]:
+            del values[key]
+
+def observe(name, value, **labels):
+    key = (name, label_key(labels))
+    with lock:
+        buckets = histograms.get(key)
+        if buckets is None:
+            buckets = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                buckets[i] += 1
+                break
+        else:
+            buckets[len(LATENCY_BUCKETS)] += 1
+        buckets[-1] += value
+
+def add_collector(collector):
+    """Register a function called on every scrape to refresh values owned by other modules."""
+    collectors.append(collector)
+
+class Trace:
+    """Stage timings (and optionally a profiler) of one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.profiler = None
+        self.lock = threading.Lock()
+
+    def add(self, stage_name, seconds):
+        with self.lock:
+            self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """Stage durations as a Server-Timing header value."""
+        with self.lock:
+            return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items())
+
+def start_trace():
+    trace = Trace()
+    current_trace.set(trace)
+    return trace
+
+def elapsed():
+    """Seconds since the current request started, or 0 outside a request."""
+    trace = current_trace.get()
+    return trace.elapsed() if trace is not None else 0.0
+
+def stage_timings():
+    """{stage: milliseconds} recorded so far by the current request."""
+    trace = current_trace.get()
+    if trace is None:
+        return {}
+    with trace.lock:
+        return {name: seconds * 1000 for name, seconds in trace.stages.items()}
+
+@contextlib.contextmanager
+def stage(stage_name):
+    """Time a block into the stage latency histogram and the current request's trace."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_time
+        observe("stage_duration_seconds", seconds, stage=stage_name)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(stage_name, seconds)
+
+class SamplingProfiler:
+    """Samples the stacks of the threads attached to it every `interval` seconds.
+
+    Stacks are kept in collapsed form ("outer;...;inner"), ready for flame graph tools.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.thread_ids = set()
+        self.samples = Counter()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    @contextlib.contextmanager
+    def attach(self):
+        """Sample the calling thread while inside the block."""
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.thread_ids.add(thread_id)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.thread_ids.discard(thread_id)
+
+    def report(self, top=PROFILE_TOP_STACKS):
+        total = sum(self.samples.values())
+        return {
+            "interval_ms": self.interval * 1000,
+            "samples": total,
+            "stacks": [{"stack": stack, "samples": count} for stack, count in self.samples.most_common(top)],
+        }
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                thread_ids = list(self.thread_ids)
+            if not thread_ids:
+                continue
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                if stack:
+                    self.samples[";".join(reversed(stack))] += 1
+
+def start_profiler():
+    """Start sampling the work the current request hands to executors."""
+    trace = current_trace.get()
+    if trace is not None and trace.profiler is None:
+        trace.profiler = SamplingProfiler()
+        trace.profiler.start()
+
+def stop_profiler():
+    """Stop the current request's profiler and return its report, or None if it was not profiled."""
+    trace = current_trace.get()
+    if trace is None or trace.profiler is None:
+        return None
+    trace.profiler.stop()
+    return trace.profiler.report()
+
+def profiled(function, *args, **kwargs):
+    """Call `function`, sampling this thread if the current request is being profiled."""
+    trace = current_trace.get()
+    if trace is None or trace.profiler is None:
+        return function(*args, **kwargs)
+    with trace.profiler.attach():
+        return function(*args, **kwargs)
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    for collector in collectors:
+        try:
+            collector()
+        except Exception as e:
+            print(f"Error collecting metrics: {e}")
+
+    with lock:
+        value_items = sorted(values.items())
+        histogram_items = sorted((key, list(buckets)) for key, buckets in histograms.items())
+
+    lines = []
+    described = set()
+
+    def header(name, default_type):
+        if name not in described:
+            described.add(name)
+            metric_type, help_text = metric_types.get(name, (default_type, ""))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+    for (name, labels), value in value_items:
+        header(name, "gauge")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    for (name, labels), buckets in histogram_items:
+        header(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, buckets):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+        cumulative += buckets[len(LATENCY_BUCKETS)]
+        lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {buckets[-1]}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+describe("http_requests_total", "counter", "Requests answered, by route, method and status.")
+describe("http_request_duration_seconds", "histogram", "Request latency by route.")
+describe("stage_duration_seconds", "histogram", "Time spent in each query stage.")
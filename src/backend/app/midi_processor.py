@@ -1,15 +1,149 @@
 from tqdm import tqdm
 import time
 import os
+import io
+import mmap
 import numpy as np
 import mido
-import random
+import multiprocessing
 import concurrent.futures
-import functools
+import feature_cache
+import metrics
+
+SCORE_CHUNK_SIZE = 65536  # Database windows scored per matrix product
+PRUNE_CHUNK_SIZE = 4096  # Database windows scored between early-termination checks
+DEQUANTIZE_CHUNK_SIZE = 2048  # Quantized windows widened to float32 at a time; small enough to stay in cache
+QUERY_SAMPLING_MODES = ("all", "stride", "random")
+MAX_QUERY_WINDOWS = 16  # Query windows kept by the stride and random sampling modes
+FEATURE_DTYPES = ("float32", "float16", "uint8")
+FEATURE_DTYPE = "uint8"  # Storage type of the stacked database windows scanned by queries
+EXACT_RERANK_DEPTH = 10  # Leading ranks re-scored at full precision when no top_k is given
+FEATURE_BLOCKS = (slice(0, 25), slice(25, 50), slice(50, 75))  # ATB, RTB and FTB columns of a stacked row
+
+# Data bytes following each system common status byte; undefined ones are rejected like mido does
+SYSTEM_MESSAGE_LENGTHS = {0xF1: 1, 0xF2: 2, 0xF3: 1, 0xF6: 0, 0xF8: 0, 0xFA: 0, 0xFB: 0, 0xFC: 0, 0xFE: 0}
 
-@functools.lru_cache(maxsize=128)
 def get_midi_notes(file_path):
-    midi_data = mido.MidiFile(file_path)
+    with open(file_path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            data = b""
+        try:
+            return parse_midi_notes(data)
+        except Exception:
+            # Anything the lean parser rejects gets mido's full treatment (and its error)
+            return np.array(get_midi_notes_mido(file_path), dtype=np.int8)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+def get_midi_notes_from_bytes(data):
+    try:
+        return parse_midi_notes(data)
+    except Exception:
+        return np.array(read_midi_notes(mido.MidiFile(file=io.BytesIO(data))), dtype=np.int8)
+
+def get_midi_notes_mido(file_path):
+    return read_midi_notes(mido.MidiFile(file_path))
+
+def read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+def parse_midi_notes(data):
+    # Single pass over the raw SMF track chunks, keeping only sounding note-on events.
+    # Returns the same notes as read_midi_notes, as an int8 array.
+    if data[:4] != b"MThd":
+        raise ValueError("MThd not found. Probably not a MIDI file")
+    header_size = int.from_bytes(data[4:8], "big")
+    if header_size < 6:
+        raise EOFError
+    num_tracks = int.from_bytes(data[10:12], "big")
+
+    channels = bytearray()
+    pitches = bytearray()
+    pos = 8 + header_size
+    for _ in range(num_tracks):
+        if data[pos:pos + 4] != b"MTrk":
+            raise ValueError("no MTrk header at start of track")
+        size = int.from_bytes(data[pos + 4:pos + 8], "big")
+        track = data[pos + 8:pos + 8 + size]
+        if len(track) < size:
+            raise EOFError
+        pos += 8 + size
+
+        i = 0
+        last_status = None
+        while i < size:
+            # Skip the delta time
+            while track[i] & 0x80:
+                i += 1
+            status = track[i + 1]
+            running = status < 0x80
+            if running:
+                if last_status is None:
+                    raise ValueError("running status without last_status")
+                status = last_status
+                i += 1
+            else:
+                i += 2
+                if status != 0xFF:
+                    last_status = status
+
+            kind = status & 0xF0
+            if kind == 0x90:
+                pitch = track[i]
+                velocity = track[i + 1]
+                if pitch > 127 or velocity > 127:
+                    raise ValueError("data byte must be in range 0..127")
+                if velocity:
+                    channels.append(status & 0x0F)
+                    pitches.append(pitch)
+                i += 2
+            elif kind == 0xC0 or kind == 0xD0:
+                if track[i] > 127:
+                    raise ValueError("data byte must be in range 0..127")
+                i += 1
+            elif kind < 0xF0:
+                if track[i] > 127 or track[i + 1] > 127:
+                    raise ValueError("data byte must be in range 0..127")
+                i += 2
+            elif status == 0xFF:
+                length, i = read_varlen(track, i + 1)
+                i += length
+            elif status == 0xF0 or status == 0xF7:
+                # mido drops the byte that triggered running status before reading a sysex
+                length, i = read_varlen(track, i + 1 if running else i)
+                i += length
+            elif status in SYSTEM_MESSAGE_LENGTHS:
+                i += SYSTEM_MESSAGE_LENGTHS[status]
+            else:
+                raise ValueError(f"undefined status byte 0x{status:02x}")
+        if i != size:
+            raise ValueError("track data does not end on its chunk boundary")
+
+    channels = np.frombuffer(bytes(channels), dtype=np.uint8)
+    notes = np.frombuffer(bytes(pitches), dtype=np.int8)
+    preferred = (channels == 0) | (channels == 3)
+    if np.any(preferred):
+        return notes[preferred]
+
+    # Busiest channel, ties going to the one that sounded first (like max() over an insertion-ordered dict)
+    if len(channels) == 0:
+        raise ValueError("no note_on events found")
+    counts = np.bincount(channels, minlength=16)
+    busiest = np.flatnonzero(counts == counts.max())
+    first_seen = [np.argmax(channels == channel) for channel in busiest]
+    return notes[channels == busiest[int(np.argmin(first_seen))]]
+
+def read_midi_notes(midi_data):
     notes = []
     dict = {}
 
@@ -33,94 +167,88 @@ def get_midi_notes(file_path):
 
     return notes
 
-def shrink_atb_histogram(hist):
-    hist = hist.astype(float)
-    total = np.sum(hist)
-    now = 0
-    center = 0
-    for i in range(128):
-        now += hist[i]
-        if now >= total / 2:
-            center = i
-            break
-    hist /= total
-    left = max(0, int(center) - 12)
-    right = min(len(hist), int(center) + 12 + 1)
-    reduced_hist = hist[left:right]
-
-    padding_left = max(0, 12 - (int(center) - left))
-    padding_right = max(0, 25 - len(reduced_hist) - padding_left)
-
-    # Create a 25-length array
-    final_array = np.concatenate((np.zeros(padding_left), reduced_hist, np.zeros(padding_right)))
-    return final_array
-
-def shrink_rtb_ftb_histogram(hist):
-    hist = hist.astype(float)
-    total = np.sum(hist)
-    hist /= (total if total != 0 else 1)
+def validate_midi_parser(directory):
+    # Compare the lean parser against mido on every MIDI file in a directory and time both
+    mismatches = []
+    fast_seconds = mido_seconds = 0.0
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.mid'):
+            continue
+        file_path = os.path.join(directory, file_name)
+        start_time = time.perf_counter()
+        try:
+            expected = get_midi_notes_mido(file_path)
+        except Exception:
+            expected = None
+        mido_seconds += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        try:
+            with open(file_path, "rb") as f:
+                notes = parse_midi_notes(f.read()).tolist()
+        except Exception:
+            notes = None
+        fast_seconds += time.perf_counter() - start_time
+
+        if notes != expected:
+            mismatches.append(file_name)
+    return mismatches, mido_seconds, fast_seconds
+
+def shrink_atb_histograms(hists):
+    # Center every row on its median pitch and keep 12 bins either side (25 in total)
+    total = np.sum(hists, axis=1, keepdims=True)
+    centers = np.argmax(np.cumsum(hists, axis=1) >= total / 2, axis=1)
+    hists = hists / total
+
+    positions = centers[:, None] + np.arange(-12, 13)
+    inside = (positions >= 0) & (positions < hists.shape[1])
+    reduced = np.take_along_axis(hists, np.clip(positions, 0, hists.shape[1] - 1), axis=1)
+    return np.where(inside, reduced, 0.0)
+
+def shrink_rtb_ftb_histograms(hists):
+    # Fold every row of 255 interval bins onto [-12, 12], clamping wider intervals into the end bins
+    total = np.sum(hists, axis=1, keepdims=True)
+    hists = hists / np.where(total != 0, total, 1)
     center = 128
     left = center - 12
     right = center + 12
-    reduced_hist = np.zeros(25, dtype=float)
-    for i in range(len(hist)):
-        if i < left:
-            reduced_hist[0] += hist[i]
-        elif i > right:
-            reduced_hist[-1] += hist[i]
-        else:
-            reduced_hist[i - left] += hist[i]
-    return reduced_hist
+    # Bins up to `left` land in the first slot, bins from `right` on in the last
+    boundaries = np.concatenate(([0], np.arange(left + 1, right + 1)))
+    return np.add.reduceat(hists, boundaries, axis=1)
+
+def window_histograms(values, valid, num_bins):
+    # One histogram row per window, counting only the valid positions
+    rows = np.broadcast_to(np.arange(len(values))[:, None], values.shape)
+    flat_bins = (rows * num_bins + values)[valid]
+    counts = np.bincount(flat_bins, minlength=len(values) * num_bins).reshape(len(values), num_bins).astype(float)
+    return counts / np.maximum(np.sum(counts, axis=1, keepdims=True), 1)
 
 def get_feature(notes, window_size=40, step=20):
-    atb_arrays = []
-    rtb_arrays = []
-    ftb_arrays = []
-
-    for i in range(0, len(notes), step):
-        start = i
-        end = start + window_size - 1
-        
-        if start >= len(notes):
-            break
-
-        current_windows = notes[start:end + 1]
-        atb_hist = np.zeros(128, dtype=float)
-        unique, counts = np.unique(current_windows, return_counts=True)
-        atb_hist[unique] = counts
-        atb_hist_norm = atb_hist / max(np.sum(atb_hist), 1)
-
-        intervals = np.diff(current_windows)
-        rtb_hist = np.zeros(255, dtype=float)
-        unique_intervals, counts = np.unique(intervals + 127, return_counts=True)
-        rtb_hist[unique_intervals] = counts
-        rtb_hist_norm = rtb_hist / max(np.sum(rtb_hist), 1)
-
-        first_note = notes[0]
-        ftb_hist = np.zeros(255, dtype=float)
-        ftb_intervals = [note - first_note for note in current_windows[1:]]
-        unique_ftb, counts = np.unique(np.array(ftb_intervals) + 127, return_counts=True)
-        ftb_hist[unique_ftb] = counts
-        ftb_hist_norm = ftb_hist / max(np.sum(ftb_hist), 1)
-
-        atb_arrays.append(shrink_atb_histogram(atb_hist_norm))
-        rtb_arrays.append(shrink_rtb_ftb_histogram(rtb_hist_norm))
-        ftb_arrays.append(shrink_rtb_ftb_histogram(ftb_hist_norm))
-
-    # Convert lists of arrays into a single numpy array: shape (num_windows, 25)
-    if len(atb_arrays) == 0:
+    notes = np.asarray(notes, dtype=np.int64)
+    if len(notes) == 0:
         return np.empty((0,25)), np.empty((0,25)), np.empty((0,25))
 
-    atb_feature_array = np.stack(atb_arrays, axis=0)
-    rtb_feature_array = np.stack(rtb_arrays, axis=0)
-    ftb_feature_array = np.stack(ftb_arrays, axis=0)
+    # Pad so the short windows at the tail are full-width views too, then mask the padding out
+    starts = np.arange(0, len(notes), step)
+    padded = np.concatenate((notes, np.zeros(window_size, dtype=np.int64)))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window_size)[starts]
+    valid = starts[:, None] + np.arange(window_size) < len(notes)
+
+    atb_hists = window_histograms(windows, valid, 128)
+    rtb_hists = window_histograms(np.diff(windows, axis=1) + 127, valid[:, 1:], 255)
+    # FTB intervals are measured from the first note of the whole song
+    ftb_hists = window_histograms(windows[:, 1:] - notes[0] + 127, valid[:, 1:], 255)
+
+    atb_feature_array = shrink_atb_histograms(atb_hists)
+    rtb_feature_array = shrink_rtb_ftb_histograms(rtb_hists)
+    ftb_feature_array = shrink_rtb_ftb_histograms(ftb_hists)
     return atb_feature_array, rtb_feature_array, ftb_feature_array
 
 def process_single_midi_file(file_path):
     try:
         notes = get_midi_notes(file_path)
         features = get_feature(notes)
-        return file_path, features
+        return file_path, features + (np.asarray(notes, dtype=np.int16),)
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
         return None, None
@@ -130,65 +258,356 @@ def cosine_similarity(vec1, vec2):
         return 0.0
     return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
 
-def process_all_midi_files_concurrently(directory):
+def process_midi_bytes(file_name, data):
+    try:
+        notes = get_midi_notes_from_bytes(data)
+        features = get_feature(notes)
+        return file_name, features + (np.asarray(notes, dtype=np.int16),)
+    except Exception as e:
+        print(f"Error processing {file_name}: {e}")
+        return None, None
+
+def process_midi_files_concurrently(midi_files, content_hashes=None, cache=None):
+    # With content hashes, songs already in the feature cache skip parsing and new results are cached
+    cache = cache or feature_cache.shared_cache
     preprocess_result = []
+    pending = []
+    for index, midi_file in enumerate(midi_files):
+        cached = cache.get(content_hashes[index]) if content_hashes is not None else None
+        if cached is not None:
+            preprocess_result.append((os.path.basename(midi_file),) + cached)
+        else:
+            pending.append(index)
+    if not pending:
+        return preprocess_result
+
+    # Spawned, not forked: ingests run on a thread of the server process
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(process_single_midi_file, midi_files[index]): index for index in pending}
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(pending), desc="Processing Database"):
+            file_path, features = future.result()
+            if file_path is not None and features is not None:
+                preprocess_result.append((os.path.basename(file_path), features[0], features[1], features[2], features[3]))
+                if content_hashes is not None:
+                    cache.put(content_hashes[futures[future]], features)
+
+    return preprocess_result
+
+def get_cached_features(data, cache=None):
+    # (ATB, RTB, FTB, notes) of a MIDI file's bytes, parsed only on a cache miss
+    cache = cache or feature_cache.shared_cache
+    key = feature_cache.content_key(data)
+    features = cache.get(key)
+    if features is None:
+        with metrics.stage("note_extraction"):
+            notes = get_midi_notes_from_bytes(data)
+        with metrics.stage("feature_extraction"):
+            features = get_feature(notes) + (np.asarray(notes, dtype=np.int16),)
+        cache.put(key, features)
+    return features
+
+def process_all_midi_files_concurrently(directory):
     midi_files = []
-    path_to_title = {}
     for root, _, files in os.walk(directory):
         for file in files:
             if file.endswith(".mid"):
                 midi_files.append(os.path.join(root, file))
-                path_to_title[os.path.join(root, file)] = file
 
     if not midi_files:
         print("No MIDI files found in the directory.")
-        return [], []
-
-    with concurrent.futures.ProcessPoolExecutor(max_workers=None) as executor:
-        futures = {executor.submit(process_single_midi_file, midi_file): midi_file for midi_file in midi_files}
-        for future in tqdm(concurrent.futures.as_completed(futures), total=len(midi_files), desc="Processing Database"):
-            file_path, features = future.result()
-            if file_path is not None and features is not None:
-                preprocess_result.append((path_to_title[file_path], features[0], features[1], features[2]))
-
-    return preprocess_result
-
-def compute_similarity_for_feature(feature, queries):
-    song_name, feature_ATB, feature_RTB, feature_FTB = feature
-    query_ATB, query_RTB, query_FTB = queries
-    max_similarity = 0.0
-
-    # Ensure queries are arrays
-    # Since we already have arrays, no change needed here.
-    for i in range(len(feature_ATB)):
-        # Random sampling from query
-        max_idx = min(len(query_ATB), 15)
-        for _ in range(max_idx):
-            idx = random.randint(0, len(query_ATB) - 1)
-            ATB_similarity = cosine_similarity(feature_ATB[i], query_ATB[idx])
-            RTB_similarity = cosine_similarity(feature_RTB[i], query_RTB[idx])
-            FTB_similarity = cosine_similarity(feature_FTB[i], query_FTB[idx])
-            similarity_score = (ATB_similarity + RTB_similarity + FTB_similarity) / 3.0
-            if similarity_score > max_similarity:
-                max_similarity = similarity_score
-
-    return (song_name, max_similarity)
-
-def compare(features, queries):
-    results = []
-    with concurrent.futures.ProcessPoolExecutor(max_workers=None) as executor:
-        futures = {
-            executor.submit(compute_similarity_for_feature, feature, queries): feature
-            for feature in features
-        }
-
-        for future in tqdm(concurrent.futures.as_completed(futures), total=len(features), desc="Comparing Query"):
-            song_name, similarity_score = future.result()
-            results.append((song_name, similarity_score))
+        return []
+
+    return process_midi_files_concurrently(midi_files)
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def stack_features(feature_ATB, feature_RTB, feature_FTB):
+    # Each block is L2-normalized and scaled by 1/sqrt(3), so the dot product of two
+    # stacked rows is the mean of the ATB, RTB and FTB cosine similarities.
+    stacked = np.hstack((normalize_rows(feature_ATB), normalize_rows(feature_RTB), normalize_rows(feature_FTB)))
+    return np.ascontiguousarray(stacked / np.sqrt(3), dtype=np.float32)
+
+def segment_offsets(counts):
+    offsets = np.zeros(len(counts), dtype=np.int64)
+    if len(counts) > 1:
+        offsets[1:] = np.cumsum(counts)[:-1]
+    return offsets
+
+def quantize_features(stacked, dtype=FEATURE_DTYPE):
+    # Stacked rows -> (codes, per-block scales), or (rows, None) for float32. uint8 codes map
+    # each ATB/RTB/FTB block's largest value to 255 and float16 codes round the rows; each
+    # block's scale restores its norm of 1/sqrt(3), so codes * scales approximate the rows.
+    if dtype not in FEATURE_DTYPES:
+        raise ValueError(f"Unknown feature dtype: {dtype}")
+    stacked = np.ascontiguousarray(stacked, dtype=np.float32).reshape(-1, 75)
+    if dtype == "float32":
+        return stacked, None
+    if dtype == "uint8":
+        codes = np.empty(stacked.shape, dtype=np.uint8)
+        for block in FEATURE_BLOCKS:
+            peaks = np.max(stacked[:, block], axis=1, keepdims=True)
+            peaks[peaks == 0] = 1
+            codes[:, block] = np.rint(stacked[:, block] / peaks * 255)
+    else:
+        codes = stacked.astype(dtype)
+
+    scales = np.zeros((len(stacked), len(FEATURE_BLOCKS)), dtype=np.float32)
+    for i, block in enumerate(FEATURE_BLOCKS):
+        norms = np.linalg.norm(codes[:, block].astype(np.float32), axis=1)
+        nonzero = norms > 0
+        scales[nonzero, i] = 1 / (np.sqrt(3) * norms[nonzero])
+    return codes, scales
+
+def dequantize_features(codes, scales):
+    rows = np.array(codes, dtype=np.float32)
+    if scales is not None:
+        for i, block in enumerate(FEATURE_BLOCKS):
+            rows[:, block] *= scales[:, i:i + 1]
+    return rows
+
+def quantization_errors(stacked, codes, scales):
+    # Per window, the most its quantized score can be off for any query: each block's
+    # deviation times the query block's norm of 1/sqrt(3)
+    errors = np.zeros(len(stacked), dtype=np.float32)
+    if scales is None:
+        return errors
+    for start in range(0, len(stacked), SCORE_CHUNK_SIZE):
+        rows = slice(start, start + SCORE_CHUNK_SIZE)
+        deviation = dequantize_features(codes[rows], scales[rows]) - stacked[rows]
+        errors[rows] = sum(np.linalg.norm(deviation[:, block], axis=1) for block in FEATURE_BLOCKS) / np.sqrt(3)
+    return errors
+
+def song_envelopes(features, scales, offsets, counts):
+    # Elementwise max over each song's (dequantized) windows. Features are non-negative, so a
+    # query row's dot product with the envelope bounds its score against every window of the song.
+    envelopes = np.zeros((len(counts), features.shape[1]), dtype=np.float32)
+    song_ids = np.flatnonzero(counts > 0)
+    starts = offsets[song_ids]
+    start = 0
+    while start < len(song_ids):
+        # Dequantize about SCORE_CHUNK_SIZE windows of whole songs at a time
+        end = max(start + 1, int(np.searchsorted(starts, starts[start] + SCORE_CHUNK_SIZE)))
+        first = starts[start]
+        last = starts[end - 1] + counts[song_ids[end - 1]]
+        rows = dequantize_features(features[first:last], None if scales is None else scales[first:last])
+        envelopes[song_ids[start:end]] = np.maximum.reduceat(rows, starts[start:end] - first, axis=0)
+        start = end
+    return envelopes
+
+def pack_feature_index(song_names, blocks, note_blocks, dtype=FEATURE_DTYPE):
+    # `blocks` holds each song's stacked float32 windows; scoring runs on their `dtype` codes
+    counts = np.array([len(block) for block in blocks], dtype=np.int64)
+    note_counts = np.array([len(block) for block in note_blocks], dtype=np.int64)
+    stacked = np.concatenate(blocks, axis=0) if blocks else np.empty((0, 75), dtype=np.float32)
+    notes = np.concatenate(note_blocks) if note_blocks else np.empty(0, dtype=np.int16)
+    offsets = segment_offsets(counts)
+    features, scales = quantize_features(stacked, dtype)
+
+    song_errors = np.zeros(len(counts), dtype=np.float32)
+    window_errors = quantization_errors(stacked, features, scales)
+    non_empty = counts > 0
+    if np.any(non_empty):
+        song_errors[non_empty] = np.maximum.reduceat(window_errors, offsets[non_empty])
+    return {
+        "song_names": list(song_names),
+        "offsets": offsets,
+        "counts": counts,
+        "features": features,
+        "feature_scales": scales,
+        # Full-precision windows (quantized indexes only); read just to re-score near-ties
+        "exact_features": None if scales is None else stacked,
+        "song_errors": song_errors,
+        "envelopes": song_envelopes(features, scales, offsets, counts),
+        # Raw note sequences, used for candidate pruning and re-ranking
+        "note_offsets": segment_offsets(note_counts),
+        "note_counts": note_counts,
+        "notes": np.ascontiguousarray(notes, dtype=np.int16),
+    }
+
+def get_song_notes(feature_index, song_id):
+    offset = feature_index["note_offsets"][song_id]
+    return feature_index["notes"][offset:offset + feature_index["note_counts"][song_id]]
+
+def get_song_windows(feature_index, song_id):
+    # Full-precision stacked windows of one song
+    offset = feature_index["offsets"][song_id]
+    rows = slice(offset, offset + feature_index["counts"][song_id])
+    if feature_index["feature_scales"] is None:
+        return feature_index["features"][rows]
+    if feature_index["exact_features"] is not None:
+        return feature_index["exact_features"][rows]
+    return dequantize_features(feature_index["features"][rows], feature_index["feature_scales"][rows])
+
+def build_feature_index(preprocess_result, dtype=FEATURE_DTYPE):
+    song_names = []
+    blocks = []
+    note_blocks = []
+    for song_name, feature_ATB, feature_RTB, feature_FTB, notes in preprocess_result:
+        song_names.append(song_name)
+        blocks.append(stack_features(feature_ATB, feature_RTB, feature_FTB))
+        note_blocks.append(np.asarray(notes, dtype=np.int16))
+    return pack_feature_index(song_names, blocks, note_blocks, dtype)
+
+def update_feature_index(feature_index, preprocess_result, removed_names=(), dtype=FEATURE_DTYPE):
+    # Keep the stacked windows of untouched songs and append the freshly processed ones
+    replaced = set(removed_names) | {entry[0] for entry in preprocess_result}
+    song_names = []
+    blocks = []
+    note_blocks = []
+    for song_id, song_name in enumerate(feature_index["song_names"]):
+        if song_name not in replaced:
+            song_names.append(song_name)
+            blocks.append(get_song_windows(feature_index, song_id))
+            note_blocks.append(get_song_notes(feature_index, song_id))
+
+    for song_name, feature_ATB, feature_RTB, feature_FTB, notes in preprocess_result:
+        song_names.append(song_name)
+        blocks.append(stack_features(feature_ATB, feature_RTB, feature_FTB))
+        note_blocks.append(np.asarray(notes, dtype=np.int16))
+    return pack_feature_index(song_names, blocks, note_blocks, dtype)
+
+def score_windows(features, scales, query_matrix):
+    # Best query match for every database window, computed in chunks to bound memory
+    window_scores = np.zeros(len(features), dtype=np.float32)
+    if len(query_matrix) == 0:
+        return window_scores
+    if scales is None:
+        for start in range(0, len(features), SCORE_CHUNK_SIZE):
+            block = features[start:start + SCORE_CHUNK_SIZE]
+            window_scores[start:start + len(block)] = np.max(block @ query_matrix.T, axis=1)
+        return window_scores
+
+    # Codes are widened into a small reusable buffer and rescaled block by block in place
+    buffer = np.empty((min(len(features), DEQUANTIZE_CHUNK_SIZE), features.shape[1]), dtype=np.float32)
+    for start in range(0, len(features), DEQUANTIZE_CHUNK_SIZE):
+        codes = features[start:start + DEQUANTIZE_CHUNK_SIZE]
+        rows = buffer[:len(codes)]
+        rows[...] = codes
+        rows.reshape(len(codes), len(FEATURE_BLOCKS), -1)[...] *= scales[start:start + len(codes), :, None]
+        window_scores[start:start + len(codes)] = np.max(rows @ query_matrix.T, axis=1)
+    return window_scores
+
+def sample_query_windows(query_matrix, mode="all", max_windows=MAX_QUERY_WINDOWS, seed=0):
+    # "all" keeps every query window; "stride" keeps evenly spaced ones and "random"
+    # a seeded sample, so the same query always ranks the same way
+    if mode not in QUERY_SAMPLING_MODES:
+        raise ValueError(f"Unknown sampling mode: {mode}")
+    if mode == "all" or len(query_matrix) <= max_windows:
+        return query_matrix
+    if mode == "stride":
+        rows = np.unique(np.linspace(0, len(query_matrix) - 1, max_windows).round().astype(np.int64))
+    else:
+        rows = np.sort(np.random.default_rng(seed).choice(len(query_matrix), max_windows, replace=False))
+    return query_matrix[rows]
+
+def score_songs(feature_index, song_ids, query_matrix, exact=False):
+    # Best window score of each song in `song_ids`, on the full-precision windows if `exact`
+    if exact and feature_index["exact_features"] is not None:
+        features, scales = feature_index["exact_features"], None
+    else:
+        features, scales = feature_index["features"], feature_index["feature_scales"]
+    counts = feature_index["counts"][song_ids]
+    offsets = feature_index["offsets"][song_ids]
+    if len(song_ids) == len(feature_index["counts"]) and np.array_equal(song_ids, np.arange(len(song_ids))):
+        local_offsets = offsets
+    else:
+        local_offsets = segment_offsets(counts)
+        rows = np.repeat(offsets - local_offsets, counts) + np.arange(np.sum(counts))
+        features = features[rows]
+        scales = None if scales is None else scales[rows]
+
+    song_scores = np.zeros(len(song_ids), dtype=np.float32)
+    window_scores = score_windows(features, scales, query_matrix)
+    non_empty = counts > 0
+    if np.any(non_empty):
+        song_scores[non_empty] = np.maximum.reduceat(window_scores, local_offsets[non_empty])
+    return np.maximum(song_scores, 0.0)
+
+def score_top_songs(feature_index, song_ids, query_matrix, top_k):
+    # Scores songs in descending order of their envelope bound and stops once no
+    # remaining song can beat the current k-th best score
+    bounds = np.zeros(len(song_ids), dtype=np.float32)
+    if len(query_matrix):
+        # Bound the ATB, RTB and FTB terms separately; none can exceed its 1/3 share
+        envelopes = feature_index["envelopes"][song_ids]
+        block_bounds = [np.minimum(envelopes[:, block] @ query_matrix[:, block].T, 1 / 3)
+                        for block in FEATURE_BLOCKS]
+        bounds = np.max(sum(block_bounds), axis=1)
+    order = np.argsort(-bounds, kind="stable")
+    window_totals = np.cumsum(feature_index["counts"][song_ids][order])
+    # Quantized scores may be off by up to a song's error, so compare against the k-th best
+    # lower bound and keep going while any remaining song could still exceed it
+    errors = feature_index["song_errors"][song_ids]
+    max_error = float(np.max(errors)) if len(errors) else 0.0
+
+    scored_ids = []
+    scored = []
+    kth_best = -1.0
+    start = 0
+    # The tolerance absorbs float32 rounding between the bound and the real scores
+    while start < len(order) and bounds[order[start]] + max_error + 1e-5 > kth_best:
+        done = window_totals[start - 1] if start else 0
+        end = max(start + 1, int(np.searchsorted(window_totals, done + PRUNE_CHUNK_SIZE, side="right")))
+        batch = order[start:end]
+        scored_ids.append(batch)
+        scored.append(score_songs(feature_index, song_ids[batch], query_matrix))
+        lower = np.concatenate(scored) - errors[np.concatenate(scored_ids)]
+        if len(lower) >= top_k:
+            kth_best = np.partition(lower, len(lower) - top_k)[len(lower) - top_k]
+        start = end
+    if not scored:
+        return song_ids[:0], np.zeros(0, dtype=np.float32)
+    return song_ids[np.concatenate(scored_ids)], np.concatenate(scored)
+
+def refine_song_scores(feature_index, song_ids, song_scores, query_matrix, depth):
+    # Re-score on the full-precision windows every song whose quantized score could still
+    # place it in the top `depth`, so those ranks match unquantized scoring exactly
+    if feature_index["exact_features"] is None or len(song_ids) == 0:
+        return song_scores
+    errors = feature_index["song_errors"][song_ids]
+    selected = np.arange(len(song_ids))
+    if len(song_ids) > depth:
+        lower = song_scores - errors
+        threshold = np.partition(lower, len(lower) - depth)[len(lower) - depth]
+        selected = np.flatnonzero(song_scores + errors + 1e-5 >= threshold)
+    song_scores = song_scores.copy()
+    song_scores[selected] = score_songs(feature_index, song_ids[selected], query_matrix, exact=True)
+    return song_scores
+
+def score_song_ids(feature_index, song_ids, query_matrix, top_k=None):
+    # Scores the songs in `song_ids` against a stacked query; returns (song_ids, scores).
+    # With `top_k`, songs that provably cannot reach the top k may be left out.
+    if top_k is None:
+        song_scores = score_songs(feature_index, song_ids, query_matrix)
+    else:
+        song_ids, song_scores = score_top_songs(feature_index, song_ids, query_matrix, top_k)
+    return song_ids, refine_song_scores(feature_index, song_ids, song_scores, query_matrix, top_k or EXACT_RERANK_DEPTH)
+
+def compute_song_scores(feature_index, queries, candidates=None, sampling="all", max_windows=MAX_QUERY_WINDOWS, seed=0, top_k=None,
+                        scorer=None):
+    # Scores every song, or only the song ids in `candidates`; returns (song_ids, scores).
+    # `scorer` replaces score_song_ids, e.g. to spread the songs over worker processes.
+    query_matrix = sample_query_windows(stack_features(*queries), sampling, max_windows, seed)
+    if candidates is None:
+        song_ids = np.arange(len(feature_index["counts"]))
+    else:
+        song_ids = np.asarray(candidates, dtype=np.int64)
+    return (scorer or score_song_ids)(feature_index, song_ids, query_matrix, top_k)
+
+def compare(feature_index, queries, candidates=None, sampling="all", max_windows=MAX_QUERY_WINDOWS, seed=0, top_k=None,
+            scorer=None):
+    song_ids, song_scores = compute_song_scores(feature_index, queries, candidates, sampling, max_windows, seed, top_k, scorer)
+    song_names = [feature_index["song_names"][song_id] for song_id in song_ids]
 
     # Convert to np.array and sort by similarity score in descending order
-    sorted_results = np.array(results, dtype=[('song_name', 'U100'), ('similarity_score', 'f4')])
+    sorted_results = np.array(list(zip(song_names, song_scores)),
+                              dtype=[('song_name', 'U100'), ('similarity_score', 'f4')])
     sorted_results = np.sort(sorted_results, order='similarity_score')[::-1]
+    if top_k is not None:
+        sorted_results = sorted_results[:top_k]
     return sorted_results
 
 def get_similarities(sorted_results, threshold=0):
@@ -199,6 +618,33 @@ def get_similarities(sorted_results, threshold=0):
 
     return res
 
+def feature_index_bytes(feature_index, scanned_only=False):
+    # Bytes of the window arrays an index stores, including the float32 exact_features copy that quantized
+    # indexes keep for re-scoring. With `scanned_only`, just what every query scans: exact_features is only
+    # read for the few songs re-scored per query.
+    names = ("features", "feature_scales", "song_errors", "envelopes") + (() if scanned_only else ("exact_features",))
+    return sum(feature_index[name].nbytes for name in names if feature_index[name] is not None)
+
+def validate_quantization(directory, dtype=FEATURE_DTYPE, n_queries=50, top_k=10, query_length=200, seed=0):
+    # Rank excerpts of the songs in a directory against a float32 and a `dtype` index and report the queries
+    # whose top-k ranking differs, the float32 index's window bytes, and the `dtype` index's scanned and total bytes
+    preprocess_result = process_all_midi_files_concurrently(directory)
+    reference = build_feature_index(preprocess_result, "float32")
+    quantized = build_feature_index(preprocess_result, dtype)
+
+    rng = np.random.default_rng(seed)
+    mismatches = []
+    for song_id in rng.choice(len(preprocess_result), n_queries):
+        notes = preprocess_result[song_id][4]
+        start = int(rng.integers(0, max(1, len(notes) - query_length)))
+        queries = get_feature(notes[start:start + query_length])
+        expected = list(compare(reference, queries, top_k=top_k)["song_name"])
+        ranked = list(compare(quantized, queries, top_k=top_k)["song_name"])
+        if ranked != expected:
+            mismatches.append((preprocess_result[song_id][0], expected, ranked))
+    return (mismatches, feature_index_bytes(reference), feature_index_bytes(quantized, scanned_only=True),
+            feature_index_bytes(quantized))
+
 if __name__ == "__main__":
     start_time = time.time()
 
@@ -207,6 +653,7 @@ if __name__ == "__main__":
 
     # Process MIDI files concurrently
     preprocess_result = process_all_midi_files_concurrently(directory_path)
+    feature_index = build_feature_index(preprocess_result)
 
     print("Database processed successfully.")
     print(f"Pre process finished within {time.time() - start_time:.2f} seconds")
@@ -216,8 +663,8 @@ if __name__ == "__main__":
     query_notes = get_midi_notes("temp_data/anjay/Dataset MIDI 15/vivalavida.mid")
     queries = get_feature(query_notes)
 
-    # Compare similarity in parallel and get sorted results (as numpy array)
-    sorted_similarity = compare(preprocess_result, queries)
+    # Score the query against every database window and get sorted results (as numpy array)
+    sorted_similarity = compare(feature_index, queries)
     result = get_similarities(sorted_similarity)
 
     print("\nResults:")
@@ -0,0 +1,93 @@
+import os
+import numpy as np
+
+NGRAM_SIZE = 4  # Consecutive pitch intervals per n-gram
+MAX_CANDIDATES = 300  # Songs scored per query after pruning
+INTERVAL_BASE = 255  # Intervals lie in [-127, 127]
+INDEX_ARRAYS = ["keys", "posting_offsets", "postings"]
+
+def interval_ngrams(notes, n=NGRAM_SIZE):
+    """Unique transposition-invariant n-grams of pitch intervals, each packed into one int64."""
+    notes = np.asarray(notes, dtype=np.int64)
+    if len(notes) < n + 1:
+        return np.empty(0, dtype=np.int64)
+
+    intervals = np.diff(notes) + 127
+    windows = np.lib.stride_tricks.sliding_window_view(intervals, n)
+    weights = INTERVAL_BASE ** np.arange(n, dtype=np.int64)
+    return np.unique(windows @ weights)
+
+def build_ngram_index(feature_index, n=NGRAM_SIZE):
+    """Map every interval n-gram to the ids of the songs that contain it.
+
+    The postings are stored CSR-style: songs containing keys[i] are
+    postings[posting_offsets[i]:posting_offsets[i + 1]].
+    """
+    song_keys = []
+    song_ids = []
+    for song_id in range(len(feature_index["song_names"])):
+        offset = feature_index["note_offsets"][song_id]
+        keys = interval_ngrams(feature_index["notes"][offset:offset + feature_index["note_counts"][song_id]], n)
+        song_keys.append(keys)
+        song_ids.append(np.full(len(keys), song_id, dtype=np.int32))
+
+    all_keys = np.concatenate(song_keys) if song_keys else np.empty(0, dtype=np.int64)
+    all_ids = np.concatenate(song_ids) if song_ids else np.empty(0, dtype=np.int32)
+    order = np.argsort(all_keys, kind="stable")
+    keys, counts = np.unique(all_keys[order], return_counts=True)
+
+    posting_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    posting_offsets[1:] = np.cumsum(counts)
+    return {
+        "keys": keys,
+        "posting_offsets": posting_offsets,
+        "postings": all_ids[order],
+        "n": n,
+        "song_count": len(feature_index["song_names"]),
+    }
+
+def find_candidates(index, query_notes, max_candidates=MAX_CANDIDATES):
+    """Ids of the songs sharing the most interval n-grams with the query.
+
+    Returns None when the catalogue is small enough to scan in full, or when the
+    query is too short to form any n-gram or shares none with the catalogue, so
+    the caller falls back to a full scan.
+    """
+    if index["song_count"] <= max_candidates:
+        return None
+    query_keys = interval_ngrams(query_notes, index["n"])
+    if len(query_keys) == 0 or len(index["keys"]) == 0:
+        return None
+
+    keys = index["keys"]
+    positions = np.searchsorted(keys, query_keys)
+    found = positions < len(keys)
+    found[found] = keys[positions[found]] == query_keys[found]
+    positions = positions[found]
+    if len(positions) == 0:
+        return None
+
+    starts = index["posting_offsets"][positions]
+    ends = index["posting_offsets"][positions + 1]
+    matched = np.concatenate([index["postings"][start:end] for start, end in zip(starts, ends)])
+    overlap = np.bincount(matched, minlength=index["song_count"])
+
+    candidates = np.flatnonzero(overlap)
+    if len(candidates) > max_candidates:
+        best = np.argpartition(-overlap[candidates], max_candidates - 1)[:max_candidates]
+        candidates = candidates[best]
+    return np.sort(candidates)
+
+def save_ngram_index(index, directory):
+    """Write an n-gram index as one .npy per array."""
+    os.makedirs(directory, exist_ok=True)
+    for name in INDEX_ARRAYS:
+        np.save(os.path.join(directory, f"{name}.npy"), np.asarray(index[name]))
+    np.save(os.path.join(directory, "meta.npy"), np.array([index["n"], index["song_count"]], dtype=np.int64))
+
+def load_ngram_index(directory):
+    """Memory-map an n-gram index written by save_ngram_index."""
+    index = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in INDEX_ARRAYS}
+    n, song_count = np.load(os.path.join(directory, "meta.npy"))
+    index.update(n=int(n), song_count=int(song_count))
+    return index
@@ -0,0 +1,87 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+MAX_RESULT_ENTRIES = 1024
+RESULT_TTL = 600.0  # Seconds a cached ranking stays valid, as a backstop to explicit invalidation
+
+def fingerprint(*arrays):
+    """SHA-1 of the dtype, shape and bytes of the given arrays, e.g. a query's notes or pixels."""
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+def melody_fingerprint(notes):
+    """Fingerprint of a note sequence, the same whether it came from a MIDI file (int16) or humming (ints)."""
+    return fingerprint(np.asarray(notes, dtype=np.int16))
+
+def result_key(dataset, kind, query_fingerprint, params):
+    """Key of one ranking: the dataset version it ran on, what was queried and how it was scored."""
+    return (dataset["id"], dataset["content_hash"], kind, query_fingerprint, tuple(params))
+
+class ResultCache:
+    """LRU cache of query rankings with a time-to-live.
+
+    Keys start with the dataset id and content hash (see result_key), so a
+    rebuilt dataset never serves stale rankings; `invalidate` also frees the
+    old entries right away when a dataset changes or is reset.
+    """
+
+    def __init__(self, max_entries=MAX_RESULT_ENTRIES, ttl=RESULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry time, ranking)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Cached ranking for `key`, or None if missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, ranking):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.monotonic() + self.ttl, ranking)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, dataset_id=None):
+        """Drop the rankings of one dataset, or of every dataset."""
+        with self.lock:
+            if dataset_id is None:
+                self.entries.clear()
+                return
+            for key in [key for key in self.entries if key[0] == dataset_id]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+            }
+
+shared_cache = ResultCache()
@@ -0,0 +1,117 @@
+import os
+import threading
+import multiprocessing
+import concurrent.futures
+from collections import OrderedDict
+import numpy as np
+import dataset_store
+import midi_processor
+
+MIN_SHARD_WINDOWS = 65536  # Fewer windows per shard than this and the round trip costs more than the scan
+MAX_OPEN_STORES = 4  # Stored dataset versions each worker keeps mapped
+
+# Inside each worker: store path -> memory-mapped feature index
+open_indexes = OrderedDict()
+
+def get_worker_index(store_path):
+    feature_index = open_indexes.get(store_path)
+    if feature_index is None:
+        feature_index = dataset_store.load_feature_index(store_path)
+        open_indexes[store_path] = feature_index
+        while len(open_indexes) > MAX_OPEN_STORES:
+            open_indexes.popitem(last=False)
+    open_indexes.move_to_end(store_path)
+    return feature_index
+
+def score_shard(store_path, shard, query_matrix, top_k):
+    """Score one shard in a worker, mapping its store by path."""
+    return score_shard_ids(get_worker_index(store_path), shard, query_matrix, top_k)
+
+def score_shard_ids(feature_index, shard, query_matrix, top_k):
+    """Score one shard (a range or array of song ids); returns its top k, or every score."""
+    song_ids = np.arange(shard.start, shard.stop) if isinstance(shard, range) else shard
+    song_ids, song_scores = midi_processor.score_song_ids(feature_index, song_ids, query_matrix, top_k)
+    if top_k is not None and len(song_scores) > top_k:
+        best = np.argpartition(-song_scores, top_k - 1)[:top_k]
+        song_ids, song_scores = song_ids[best], song_scores[best]
+    return song_ids, song_scores
+
+def warm_up():
+    return os.getpid()
+
+def split_shards(song_ids, counts, n_shards):
+    """Cut `song_ids` into `n_shards` contiguous runs holding about the same number of windows.
+
+    Runs of consecutive ids become ranges, so a full scan sends no id arrays at all.
+    """
+    totals = np.cumsum(counts)
+    cuts = np.searchsorted(totals, totals[-1] * np.arange(1, n_shards) / n_shards)
+    shards = []
+    for part in np.split(song_ids, np.unique(cuts)):
+        if not len(part):
+            continue
+        if part[-1] - part[0] == len(part) - 1 and np.all(np.diff(part) == 1):
+            shards.append(range(int(part[0]), int(part[-1]) + 1))
+        else:
+            shards.append(part)
+    return shards
+
+class ScoringPool:
+    """Persistent worker processes that score contiguous song shards of a stored dataset.
+
+    Workers map the dataset's feature store themselves, so a query only ships
+    its small stacked query matrix and gets back each shard's top k, which are
+    merged here. Because every shard refines its own near-ties, the merged top k
+    matches what a single process would return. Datasets that were never stored,
+    or too small to split, are scored in the calling thread, as are shards whose
+    worker can no longer open the store.
+    """
+
+    def __init__(self, max_workers=None, min_shard_windows=MIN_SHARD_WINDOWS):
+        self.max_workers = max_workers or os.cpu_count()
+        self.min_shard_windows = min_shard_windows
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Spawn the workers now rather than on the first large query."""
+        with self.lock:
+            if self.executor is None:
+                # Spawned, not forked: the server process runs threads that must not be cloned mid-flight
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+                for future in [self.executor.submit(warm_up) for _ in range(self.max_workers)]:
+                    future.result()
+            return self.executor
+
+    def score(self, feature_index, song_ids, query_matrix, top_k=None):
+        """Drop-in `scorer` for midi_processor.compare; returns (song_ids, scores)."""
+        store_path = feature_index.get("store_path")
+        counts = feature_index["counts"][song_ids]
+        n_shards = min(self.max_workers, int(np.sum(counts)) // self.min_shard_windows)
+        if store_path is None or n_shards < 2:
+            return midi_processor.score_song_ids(feature_index, song_ids, query_matrix, top_k)
+
+        executor = self.start()
+        query_matrix = np.ascontiguousarray(query_matrix, dtype=np.float32)
+        shards = split_shards(song_ids, counts, n_shards)
+        futures = [executor.submit(score_shard, store_path, shard, query_matrix, top_k) for shard in shards]
+        results = []
+        for shard, future in zip(shards, futures):
+            try:
+                results.append(future.result())
+            except OSError as e:
+                # The worker could not map the store (e.g. the version was pruned after this
+                # snapshot was taken); the caller still holds the arrays, so score them here
+                print(f"Scoring worker could not load {store_path}, scoring in-process: {e}")
+                results.append(score_shard_ids(feature_index, shard, query_matrix, top_k))
+        return np.concatenate([ids for ids, _ in results]), np.concatenate([scores for _, scores in results])
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+shared_pool = ScoringPool()
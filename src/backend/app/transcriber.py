@@ -0,0 +1,114 @@
+import os
+import queue
+import threading
+import concurrent.futures
+import numpy as np
+import librosa
+from basic_pitch import ICASSP_2022_MODEL_PATH
+from basic_pitch.inference import Model, window_audio_file, unwrap_output
+from basic_pitch.constants import AUDIO_SAMPLE_RATE, AUDIO_N_SAMPLES, FFT_HOP
+import basic_pitch.note_creation as infer
+
+ONSET_THRESHOLD = 0.6
+FRAME_THRESHOLD = 0.3
+MINIMUM_NOTE_LENGTH = 0.5  # Milliseconds, as passed to basic_pitch.inference.predict before
+N_OVERLAPPING_FRAMES = 30  # Same window overlap as basic_pitch.inference.run_inference
+MAX_QUEUE_SIZE = 16  # Requests waiting for the model before new ones are rejected
+MAX_BATCH_SIZE = 8  # Requests merged into a single model call
+
+def window_audio(audio):
+    """Pad mono audio and cut it into the overlapping windows the model expects."""
+    overlap_len = N_OVERLAPPING_FRAMES * FFT_HOP
+    hop_size = AUDIO_N_SAMPLES - overlap_len
+    padded = np.concatenate([np.zeros(overlap_len // 2, dtype=np.float32), np.asarray(audio, dtype=np.float32)])
+    windows = [window for window, _ in window_audio_file(padded, hop_size)]
+    return np.stack(windows, axis=0)
+
+def load_audio(audio_path):
+    """Read an audio file as mono float32 at the model's sample rate."""
+    audio, _ = librosa.load(str(audio_path), sr=AUDIO_SAMPLE_RATE, mono=True)
+    return audio
+
+def output_to_note_events(model_output):
+    """Turn unwrapped model output into basic_pitch note events."""
+    min_note_len = int(np.round(MINIMUM_NOTE_LENGTH / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)))
+    _, note_events = infer.model_output_to_notes(
+        model_output,
+        onset_thresh=ONSET_THRESHOLD,
+        frame_thresh=FRAME_THRESHOLD,
+        min_note_len=min_note_len,
+    )
+    return note_events
+
+class TranscriptionService:
+    """Keeps the basic_pitch model resident and transcribes requests on a dedicated worker thread.
+
+    Requests wait in a bounded queue; whatever is queued when the worker becomes
+    free (up to `max_batch_size` requests) is windowed and sent through the model
+    in one call.
+    """
+
+    def __init__(self, model_path=ICASSP_2022_MODEL_PATH, max_queue_size=MAX_QUEUE_SIZE, max_batch_size=MAX_BATCH_SIZE):
+        self.model = Model(model_path)
+        self.max_batch_size = max_batch_size
+        self.requests = queue.Queue(maxsize=max_queue_size)
+        self.worker = threading.Thread(target=self._run, name="transcription-worker", daemon=True)
+        self.worker.start()
+
+    def submit(self, audio):
+        """Queue audio for transcription; raises queue.Full when the service is saturated.
+
+        `audio` is either a file path or mono float32 samples at AUDIO_SAMPLE_RATE.
+        """
+        future = concurrent.futures.Future()
+        self.requests.put_nowait((audio, future))
+        return future
+
+    def transcribe(self, audio):
+        """Blocking helper returning the note events of one recording."""
+        return self.submit(audio).result()
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            self._process_batch(batch)
+
+    def _process_batch(self, batch):
+        inputs = []
+        for audio, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if isinstance(audio, (str, os.PathLike)):
+                    audio = load_audio(audio)
+                inputs.append((future, window_audio(audio), len(audio)))
+            except Exception as e:
+                future.set_exception(e)
+
+        if not inputs:
+            return
+
+        try:
+            output = self.model.predict(np.concatenate([windows for _, windows, _ in inputs]))
+        except Exception as e:
+            for future, _, _ in inputs:
+                future.set_exception(e)
+            return
+
+        start = 0
+        for future, windows, original_length in inputs:
+            end = start + len(windows)
+            try:
+                model_output = {
+                    key: unwrap_output(value[start:end], original_length, N_OVERLAPPING_FRAMES)
+                    for key, value in output.items()
+                }
+                future.set_result(output_to_note_events(model_output))
+            except Exception as e:
+                future.set_exception(e)
+            start = end
@@ -0,0 +1,56 @@
+import pytest
+import catalogue
+import mapping_index
+
+def make_catalogue(mapping=None, n_songs=25, n_images=10):
+    files = {f"song/track{i:02d}.mid": [1, 0, str(i)] for i in range(n_songs)}
+    files.update({f"album/cover{i:02d}.jpg": [1, 0, str(i)] for i in range(n_images)})
+    return catalogue.Catalogue("demo", files, mapping or mapping_index.EMPTY_MAPPING)
+
+def walk_pages(index, positions, limit):
+    titles = []
+    page, cursor = index.page(positions, limit)
+    titles += [index.items[p]["title"] for p in page]
+    while cursor:
+        page, cursor = index.page(positions, limit, cursor=cursor)
+        titles += [index.items[p]["title"] for p in page]
+    return titles
+
+def test_cursor_pages_cover_every_item_once():
+    index = make_catalogue()
+    positions = index.search("")
+    titles = walk_pages(index, positions, 7)
+    assert titles == [item["title"] for item in index.items]
+    # Songs come before unmapped covers
+    assert titles[0] == "track00.mid" and titles[-1] == "cover09.jpg"
+
+def test_cursor_pages_filtered_results():
+    index = make_catalogue()
+    positions = index.search("track1")
+    assert walk_pages(index, positions, 3) == [f"track1{i}.mid" for i in range(10)]
+
+def test_cursor_survives_removed_item():
+    index = make_catalogue()
+    page, cursor = index.page(index.search(""), 5)
+    smaller = make_catalogue(n_songs=24)
+    # track04 (the cursor's item) no longer exists; the next page still starts after it
+    next_page, _ = smaller.page(smaller.search(""), 5, cursor=cursor)
+    assert smaller.items[next_page[0]]["title"] == "track05.mid"
+
+def test_invalid_cursor_raises():
+    index = make_catalogue()
+    with pytest.raises(ValueError):
+        index.page(index.search(""), 5, cursor="not base64!")
+
+def test_etag_tracks_version_and_request():
+    index = make_catalogue()
+    etag = index.etag("http://host/", "", 10, 0, None)
+    assert etag == make_catalogue().etag("http://host/", "", 10, 0, None)
+    assert etag.startswith('"') and etag.endswith('"')
+    assert etag != index.etag("http://host/", "", 10, 0, index.page(index.search(""), 10)[1])
+    assert etag != index.etag("http://other/", "", 10, 0, None)
+    assert etag != index.etag("http://host/", "track", 10, 0, None)
+    # Mapping a cover changes the listing, hence the version and the ETag
+    mapped = make_catalogue(mapping_index.MappingIndex([{"audio_file": "track00.mid", "pic_name": "cover00.jpg"}]))
+    assert mapped.version != index.version
+    assert mapped.etag("http://host/", "", 10, 0, None) != etag
@@ -0,0 +1,33 @@
+import numpy as np
+import dataset_registry
+from test_dataset_store import make_feature_index
+
+def make_stored(n_covers=0):
+    image_model = None
+    if n_covers:
+        image_model = {
+            "pixels": np.zeros((n_covers, 4096), dtype=np.uint8),
+            "mean_dataset": np.zeros(4096, dtype=np.float32),
+            "eigenvectors": np.zeros((4096, 8), dtype=np.float32),
+            "singular_values": np.zeros(8, dtype=np.float32),
+            "projected_dataset": np.zeros((n_covers, 8), dtype=np.float32),
+            "image_names": [f"cover{i}.png" for i in range(n_covers)],
+        }
+    return {"content_hash": "aaaa", "files": {}, "feature_index": make_feature_index(), "image_model": image_model,
+            "ivf_index": None, "melody_index": None}
+
+def test_index_size_skips_cold_arrays():
+    stored = make_stored(1000)
+    without_covers = dataset_registry.index_size(make_stored())
+    size = dataset_registry.index_size(stored)
+    # The covers' pixels and the exact feature copy stay on disk
+    assert size - without_covers == sum(stored["image_model"][name].nbytes for name in
+                                         ("mean_dataset", "eigenvectors", "singular_values", "projected_dataset"))
+
+def test_cold_arrays_do_not_force_evictions(tmp_path):
+    stored = make_stored(1000)
+    registry = dataset_registry.DatasetRegistry(str(tmp_path), memory_budget=2 * dataset_registry.index_size(stored))
+    assert stored["image_model"]["pixels"].nbytes > registry.memory_budget
+    registry.publish("first", stored)
+    registry.publish("second", make_stored(1000))
+    assert [dataset["id"] for dataset in registry.loaded_datasets()] == ["first", "second"]
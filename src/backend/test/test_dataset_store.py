@@ -0,0 +1,63 @@
+import os
+import shutil
+import numpy as np
+import dataset_store
+import midi_processor
+
+def make_feature_index(n_songs=3, seed=0):
+    rng = np.random.default_rng(seed)
+    preprocess_result = []
+    for song_id in range(n_songs):
+        notes = np.clip(60 + np.cumsum(rng.integers(-3, 4, 120)), 0, 127)
+        preprocess_result.append((f"song{song_id}.mid",) + midi_processor.get_feature(notes) + (notes.astype(np.int16),))
+    return midi_processor.build_feature_index(preprocess_result)
+
+def save_version(dataset_path, content_hash, n_songs):
+    return dataset_store.save_dataset(dataset_path, content_hash, {}, make_feature_index(n_songs), None)
+
+def test_save_dataset_publishes_and_prunes(tmp_path):
+    dataset_path = str(tmp_path / "demo")
+    first = os.path.basename(save_version(dataset_path, "bbbb", 2))
+    second = os.path.basename(save_version(dataset_path, "aaaa", 3))
+    store_path = save_version(dataset_path, "cccc", 4)
+    store_root = os.path.dirname(store_path)
+
+    # The replaced version stays until the next publish, for queries that still read it
+    assert dataset_store.read_version_pointer(store_root) == (os.path.basename(store_path), second)
+    assert sorted(dataset_store.stored_versions(store_root)) == sorted([os.path.basename(store_path), second])
+    assert first not in os.listdir(store_root)
+    assert dataset_store.load_latest(dataset_path)["content_hash"] == "cccc"
+
+def test_load_latest_follows_pointer_not_hash_order(tmp_path):
+    dataset_path = str(tmp_path / "demo")
+    older = save_version(dataset_path, "ffff", 2)
+    kept = str(tmp_path / "kept")
+    shutil.copytree(older, kept)
+    previous = save_version(dataset_path, "1111", 2)
+    newer = save_version(dataset_path, "0000", 3)
+    # A stale version that survived an interrupted prune sorts after the published one
+    shutil.copytree(kept, older)
+
+    stored = dataset_store.load_latest(dataset_path)
+    assert stored["content_hash"] == "0000"
+    assert len(stored["feature_index"]["song_names"]) == 3
+    assert not os.path.exists(older)
+    assert os.path.exists(newer)
+    assert os.path.exists(previous)
+
+def test_load_latest_falls_back_to_newest_manifest(tmp_path):
+    dataset_path = str(tmp_path / "demo")
+    older = save_version(dataset_path, "ffff", 2)
+    save_version(dataset_path, "0000", 3)
+    os.remove(os.path.join(os.path.dirname(older), dataset_store.VERSION_POINTER))
+
+    assert dataset_store.load_latest(dataset_path)["content_hash"] == "0000"
+    assert dataset_store.read_version_pointer(os.path.dirname(older))[0].endswith("0000")
+
+def test_load_latest_skips_in_progress_saves(tmp_path):
+    dataset_path = str(tmp_path / "demo")
+    store_path = save_version(dataset_path, "aaaa", 2)
+    os.makedirs(f"{store_path[:-4]}cccc.tmp")
+
+    assert dataset_store.load_latest(dataset_path)["content_hash"] == "aaaa"
+    assert os.path.exists(f"{store_path[:-4]}cccc.tmp")
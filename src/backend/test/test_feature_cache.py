@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import feature_cache
+
+def make_features(seed):
+    rng = np.random.default_rng(seed)
+    return tuple(rng.random((20, 25)) for _ in range(3)) + (rng.integers(0, 128, 400).astype(np.int16),)
+
+def disk_files(directory):
+    return sorted(name for _, _, names in os.walk(directory) for name in names if name.endswith(".npz"))
+
+def test_disk_tier_round_trip(tmp_path):
+    cache = feature_cache.FeatureCache(directory=str(tmp_path))
+    features = make_features(0)
+    cache.put("ab" * 20, features)
+
+    reloaded = feature_cache.FeatureCache(directory=str(tmp_path))
+    for expected, actual in zip(features, reloaded.get("ab" * 20)):
+        np.testing.assert_array_equal(expected, actual)
+    assert reloaded.stats()["disk_hits"] == 1
+
+def test_disk_tier_prunes_least_recently_used(tmp_path):
+    cache = feature_cache.FeatureCache(directory=str(tmp_path))
+    keys = [f"{i:02x}" * 20 for i in range(8)]
+    for i, key in enumerate(keys):
+        cache.put(key, make_features(i))
+        path = cache._disk_path(key)
+        os.utime(path, (1000 + i, 1000 + i))
+        file_size = os.path.getsize(path)
+
+    # Room for about five files: writing two more must drop the oldest ones, keeping a recently read one
+    cache = feature_cache.FeatureCache(directory=str(tmp_path), max_disk_bytes=file_size * 5.5)
+    os.utime(cache._disk_path(keys[0]), (5000, 5000))
+    cache.put("f0" * 20, make_features(100))
+
+    remaining = disk_files(tmp_path)
+    assert cache.stats()["disk_bytes"] <= file_size * 5.5
+    assert cache.stats()["disk_evictions"] > 0
+    assert f"{keys[0]}.npz" in remaining
+    assert f"{keys[1]}.npz" not in remaining
+    assert f"{'f0' * 20}.npz" in remaining
@@ -0,0 +1,16 @@
+import pytest
+from fastapi.testclient import TestClient
+
+main = pytest.importorskip("main")
+client = TestClient(main.app)
+
+@pytest.mark.parametrize("params", ["top_k=0", "top_k=-3", "nprobe=0"])
+def test_image_query_rejects_out_of_range_parameters(params):
+    response = client.post(f"/image-query/?{params}", files={"file": ("cover.png", b"", "image/png")})
+    assert response.status_code == 422
+
+@pytest.mark.parametrize("endpoint", ["/midi-query/", "/humming-query/"])
+@pytest.mark.parametrize("params", ["top_k=0", "top_k=-1", "max_windows=0", "max_windows=-5"])
+def test_melody_queries_reject_out_of_range_parameters(endpoint, params):
+    response = client.post(f"{endpoint}?{params}", files={"file": ("query.mid", b"", "audio/midi")})
+    assert response.status_code == 422
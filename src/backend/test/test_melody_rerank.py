@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import melody_rerank
+import midi_processor
+from test_midi_processor import make_preprocess_result
+
+def brute_force_dtw(query, window, band):
+    length = len(query)
+    cost = np.full((length + 1, length + 1), np.inf)
+    cost[0, 0] = 0
+    for i in range(1, length + 1):
+        for j in range(max(1, i - band), min(length, i + band) + 1):
+            cost[i, j] = abs(query[i - 1] - window[j - 1]) + min(cost[i - 1, j], cost[i, j - 1], cost[i - 1, j - 1])
+    return cost[length, length]
+
+@pytest.mark.parametrize("seed", range(10))
+def test_banded_dtw_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    length, band = int(rng.integers(4, 40)), int(rng.integers(1, 6))
+    query = rng.integers(-5, 6, length).astype(np.float32)
+    windows = rng.integers(-5, 6, (6, length)).astype(np.float32)
+    expected = np.array([brute_force_dtw(query, window, band) for window in windows])
+
+    np.testing.assert_allclose(melody_rerank.banded_dtw(query, windows, band), expected)
+    upper, lower = melody_rerank.query_envelope(query, band)
+    assert np.all(melody_rerank.lb_keogh(windows, upper, lower) <= expected + 1e-6)
+    # Windows that cannot beat their bound may be abandoned (inf); the rest are exact
+    bound = float(np.median(expected))
+    abandoned = melody_rerank.banded_dtw(query, windows, band, bound)
+    assert np.all((abandoned == expected) | (np.isinf(abandoned) & (expected >= bound)))
+
+def make_ranking(n_songs=40):
+    preprocess_result = make_preprocess_result(n_songs)
+    feature_index = midi_processor.build_feature_index(preprocess_result)
+    query_notes = preprocess_result[7][4][20:80]
+    return feature_index, midi_processor.compare(feature_index, midi_processor.get_feature(query_notes)), query_notes
+
+def test_rerank_keeps_tail_and_first_stage_scores():
+    feature_index, ranking, query_notes = make_ranking()
+    reranked, stats = melody_rerank.rerank_songs(feature_index, ranking, query_notes, top_n=10, time_budget=10)
+
+    assert stats["songs"] == 10 and not stats["over_budget"]
+    assert reranked["song_name"][0] == ranking["song_name"][0] == "song007.mid"
+    assert sorted(reranked["song_name"][:10]) == sorted(ranking["song_name"][:10])
+    assert list(reranked[10:]) == list(ranking[10:])
+    scores = dict(zip(ranking["song_name"], ranking["similarity_score"]))
+    assert all(scores[name] == score for name, score in zip(reranked["song_name"], reranked["similarity_score"]))
+
+def test_rerank_without_budget_keeps_first_stage_order():
+    feature_index, ranking, query_notes = make_ranking()
+    reranked, stats = melody_rerank.rerank_songs(feature_index, ranking, query_notes, top_n=10, time_budget=0)
+
+    assert stats["aligned"] == 0 and stats["over_budget"]
+    assert list(reranked) == list(ranking)
@@ -0,0 +1,88 @@
+import io
+import mido
+import numpy as np
+import pytest
+import midi_processor
+
+def make_midi(seed, channels=(0,), n_notes=60):
+    rng = np.random.default_rng(seed)
+    midi_file = mido.MidiFile(type=1)
+    for channel in channels:
+        track = mido.MidiTrack()
+        midi_file.tracks.append(track)
+        track.append(mido.MetaMessage("track_name", name=f"channel {channel}"))
+        track.append(mido.Message("program_change", program=int(rng.integers(0, 128)), channel=channel))
+        track.append(mido.Message("sysex", data=[1, 2, 3]))
+        for _ in range(n_notes):
+            pitch = int(rng.integers(30, 100))
+            track.append(mido.Message("note_on", note=pitch, velocity=int(rng.integers(0, 128)), channel=channel,
+                                      time=int(rng.integers(0, 200))))
+            track.append(mido.Message("control_change", control=7, value=int(rng.integers(0, 128)), channel=channel))
+            track.append(mido.Message("pitchwheel", pitch=int(rng.integers(-8192, 8192)), channel=channel))
+            track.append(mido.Message("note_off", note=pitch, channel=channel, time=int(rng.integers(0, 200))))
+    data = io.BytesIO()
+    midi_file.save(file=data)
+    return data.getvalue()
+
+def mido_notes(data):
+    return midi_processor.read_midi_notes(mido.MidiFile(file=io.BytesIO(data)))
+
+@pytest.mark.parametrize("channels", [(0,), (3, 5), (5, 9, 9), (7, 2)])
+def test_parse_midi_notes_matches_mido(channels):
+    for seed in range(5):
+        data = make_midi(seed, channels)
+        assert midi_processor.parse_midi_notes(data).tolist() == mido_notes(data)
+
+def test_parse_midi_notes_running_status():
+    # Three note-ons on channel 1 sharing one status byte, then a meta event and an end of track
+    events = bytes([0x00, 0x91, 60, 100, 0x10, 62, 90, 0x10, 64, 0, 0x00, 0xFF, 0x2F, 0x00])
+    data = (b"MThd" + (6).to_bytes(4, "big") + (0).to_bytes(2, "big") + (1).to_bytes(2, "big") + (96).to_bytes(2, "big")
+            + b"MTrk" + len(events).to_bytes(4, "big") + events)
+    assert midi_processor.parse_midi_notes(data).tolist() == mido_notes(data) == [60, 62]
+
+def test_validate_midi_parser_directory(tmp_path):
+    for seed in range(6):
+        (tmp_path / f"{seed}.mid").write_bytes(make_midi(seed, (seed % 4, 6)))
+    mismatches, _, _ = midi_processor.validate_midi_parser(str(tmp_path))
+    assert mismatches == []
+
+def test_parse_midi_notes_rejects_garbage():
+    with pytest.raises(ValueError):
+        midi_processor.parse_midi_notes(b"not a midi file")
+    data = make_midi(0)
+    with pytest.raises(Exception):
+        midi_processor.parse_midi_notes(data[:-5])
+
+def make_preprocess_result(n_songs=60, seed=0):
+    rng = np.random.default_rng(seed)
+    preprocess_result = []
+    for song_id in range(n_songs):
+        notes = np.clip(60 + np.cumsum(rng.integers(-4, 5, int(rng.integers(80, 600)))), 0, 127)
+        preprocess_result.append((f"song{song_id:03d}.mid",) + midi_processor.get_feature(notes) + (notes.astype(np.int16),))
+    return preprocess_result
+
+@pytest.mark.parametrize("dtype", ["float16", "uint8"])
+def test_quantized_top_k_matches_float32(dtype):
+    preprocess_result = make_preprocess_result()
+    reference = midi_processor.build_feature_index(preprocess_result, "float32")
+    quantized = midi_processor.build_feature_index(preprocess_result, dtype)
+    rng = np.random.default_rng(1)
+    for song_id in rng.choice(len(preprocess_result), 30):
+        notes = preprocess_result[song_id][4]
+        start = int(rng.integers(0, max(1, len(notes) - 60)))
+        queries = midi_processor.get_feature(notes[start:start + 60])
+        expected = midi_processor.compare(reference, queries, top_k=10)
+        ranked = midi_processor.compare(quantized, queries, top_k=10)
+        assert list(ranked["song_name"]) == list(expected["song_name"])
+        np.testing.assert_allclose(ranked["similarity_score"], expected["similarity_score"], atol=1e-5)
+        # Without top_k the leading ranks are re-scored exactly too
+        full = midi_processor.compare(quantized, queries)
+        assert list(full["song_name"][:midi_processor.EXACT_RERANK_DEPTH]) == \
+            list(midi_processor.compare(reference, queries)["song_name"][:midi_processor.EXACT_RERANK_DEPTH])
+
+def test_feature_index_bytes_counts_exact_copy():
+    preprocess_result = make_preprocess_result(10)
+    reference = midi_processor.build_feature_index(preprocess_result, "float32")
+    quantized = midi_processor.build_feature_index(preprocess_result, "uint8")
+    assert midi_processor.feature_index_bytes(quantized, scanned_only=True) < midi_processor.feature_index_bytes(reference) / 3
+    assert midi_processor.feature_index_bytes(quantized) > midi_processor.feature_index_bytes(reference)
@@ -0,0 +1,25 @@
+import shutil
+import numpy as np
+import dataset_store
+import midi_processor
+import scoring_pool
+from test_dataset_store import save_version
+
+def test_score_falls_back_when_store_is_gone(tmp_path):
+    dataset_path = str(tmp_path / "demo")
+    store_path = save_version(dataset_path, "aaaa", 8)
+    feature_index = dataset_store.load_dataset(dataset_path, "aaaa")["feature_index"]
+    song_ids = np.arange(len(feature_index["song_names"]))
+    notes = midi_processor.get_song_notes(feature_index, 3)
+    query_matrix = midi_processor.stack_features(*midi_processor.get_feature(notes[10:60]))
+    pool = scoring_pool.ScoringPool(max_workers=2, min_shard_windows=1)
+    try:
+        expected = pool.score(feature_index, song_ids, query_matrix, top_k=3)
+        # A newer publish pruned this version while the caller still holds its mapped arrays
+        shutil.rmtree(store_path)
+        pool.shutdown()  # Fresh workers have nothing mapped yet
+        ids, scores = pool.score(feature_index, song_ids, query_matrix, top_k=3)
+    finally:
+        pool.shutdown()
+    assert sorted(ids) == sorted(expected[0])
+    np.testing.assert_allclose(np.sort(scores), np.sort(expected[1]))